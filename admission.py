@@ -0,0 +1,209 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Dict, Optional
+
+import orjson
+from envparse import Env
+
+from metrics import Counter, Gauge, registry
+from utils import TTLCache
+
+"""
+Block for admission control of expensive routes.
+"""
+env = Env()
+
+# limits per path, the keys of a route's settings are:
+#   concurrency  - requests of the route handled at once
+#   queue        - requests waiting for a free slot, the rest get 503
+#   queue_timeout - seconds a request may wait for a slot
+#   rate, burst  - token bucket of the route, requests per second
+#   ip_rate, ip_burst - token bucket of each client address
+# a missing key disables that limit
+ADMISSION_LIMITS = env.json('ADMISSION_LIMITS', default={
+    '/user/token': {
+        'concurrency': 4, 'queue': 16, 'queue_timeout': 2.0,
+        'rate': 20, 'burst': 40, 'ip_rate': 1, 'ip_burst': 10,
+    },
+    '/user/sign-up': {
+        'concurrency': 2, 'queue': 8, 'queue_timeout': 2.0,
+        'rate': 5, 'burst': 10, 'ip_rate': 0.2, 'ip_burst': 3,
+    },
+})
+# take the client address from X-Forwarded-For, only behind a trusted proxy
+ADMISSION_TRUST_FORWARDED = env.bool('ADMISSION_TRUST_FORWARDED', default=False)
+ADMISSION_MAX_CLIENTS = env.int('ADMISSION_MAX_CLIENTS', default=10000)
+
+admission_rejections_total = registry.register(Counter(
+    'admission_rejections_total', 'Requests rejected by admission control.', ('route', 'reason'),
+))
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: float):
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Takes a token, returns 0 or how many seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RouteLimiter:
+    """
+    Token buckets of the route and its clients in front of a bounded
+    number of concurrent requests with a bounded FIFO queue.
+    """
+    def __init__(self, path: str, concurrency: Optional[int] = None, queue: int = 0,
+                 queue_timeout: float = 1.0, rate: Optional[float] = None,
+                 burst: Optional[float] = None, ip_rate: Optional[float] = None,
+                 ip_burst: Optional[float] = None):
+        self.path = path
+        self.concurrency = concurrency
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.bucket = TokenBucket(rate, burst or rate) if rate else None
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst or ip_rate
+        # a client's bucket is full again ip_burst / ip_rate after its last
+        # request, so forgetting it then changes nothing; _check_rate puts
+        # the bucket back after every request to restart that TTL
+        self.ip_buckets = TTLCache(
+            maxsize=ADMISSION_MAX_CLIENTS,
+            ttl=self.ip_burst / ip_rate if ip_rate else 0,
+        )
+        self.in_flight = 0
+        self._waiters: deque = deque()
+
+    def _check_rate(self, client: Optional[str]) -> None:
+        if self.ip_rate and client is not None:
+            bucket = self.ip_buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.ip_rate, self.ip_burst)
+            wait = bucket.take()
+            self.ip_buckets.set(client, bucket)
+            if wait:
+                raise Rejected(429, 'client_rate', 'Too many requests from this client.', wait)
+        if self.bucket is not None:
+            wait = self.bucket.take()
+            if wait:
+                raise Rejected(429, 'route_rate', 'Too many requests, try again later.', wait)
+
+    async def acquire(self, client: Optional[str]) -> None:
+        self._check_rate(client)
+        if self.concurrency is None:
+            return
+        if self.in_flight < self.concurrency and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.queue:
+            raise Rejected(503, 'queue_full', 'Server is busy, try again later.', self.queue_timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Rejected(503, 'queue_timeout', 'Server is busy, try again later.', self.queue_timeout)
+        except asyncio.CancelledError:
+            # the client went away after the slot was handed over
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        # release() handed its slot over to this request
+
+    def release(self) -> None:
+        if self.concurrency is None:
+            return
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+
+limiters: Dict[str, RouteLimiter] = {
+    path: RouteLimiter(path, **settings) for path, settings in ADMISSION_LIMITS.items()
+}
+
+registry.register(Gauge(
+    'admission_queue_depth', 'Requests waiting for admission.', ('route',),
+    lambda: {(path,): limiter.queue_depth for path, limiter in limiters.items()},
+))
+registry.register(Gauge(
+    'admission_in_flight', 'Admitted requests being handled.', ('route',),
+    lambda: {(path,): limiter.in_flight for path, limiter in limiters.items()},
+))
+
+
+def _client_address(scope) -> Optional[str]:
+    if ADMISSION_TRUST_FORWARDED:
+        for name, value in scope['headers']:
+            if name == b'x-forwarded-for':
+                return value.decode('latin-1').split(',')[0].strip()
+    client = scope.get('client')
+    return client[0] if client else None
+
+
+async def _reject(send, rejected: Rejected) -> None:
+    body = orjson.dumps({'detail': rejected.detail})
+    await send({
+        'type': 'http.response.start',
+        'status': rejected.status_code,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'retry-after', str(max(1, math.ceil(rejected.retry_after))).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the limits of ADMISSION_LIMITS by path.
+    Requests are rejected before their body is read, other paths pass through.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limiter = limiters.get(scope['path']) if scope['type'] == 'http' else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await limiter.acquire(_client_address(scope))
+        except Rejected as rejected:
+            admission_rejections_total.inc(limiter.path, rejected.reason)
+            await _reject(send, rejected)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,178 @@
+import hashlib
+from decimal import Decimal
+from types import SimpleNamespace
+from typing import Any, NamedTuple, Optional
+from uuid import UUID
+
+from envparse import Env
+from fastapi import Response
+
+from database.notify import broadcast
+from utils import TTLCache
+
+"""
+Block for caching serialized responses of post reads.
+"""
+env = Env()
+
+# variables to configure the response cache
+POSTS_CACHE_MAX_ENTRIES = env.int('POSTS_CACHE_MAX_ENTRIES', default=4096)
+POSTS_CACHE_MAX_BYTES = env.int('POSTS_CACHE_MAX_BYTES', default=32 * 1024 * 1024)
+# bounds staleness caused by writes of other processes when invalidations
+# are not broadcast (BROADCAST_INVALIDATIONS) or their channel is down
+POSTS_CACHE_TTL_SECONDS = env.float('POSTS_CACHE_TTL_SECONDS', default=30.0)
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+    headers: dict
+    # set for GET /posts/{post_id}
+    post_id: Optional[int] = None
+    # set for GET /posts/, the filters of the listing
+    filters: Optional[dict] = None
+
+
+posts_cache = TTLCache(
+    maxsize=POSTS_CACHE_MAX_ENTRIES,
+    ttl=POSTS_CACHE_TTL_SECONDS,
+    maxweight=POSTS_CACHE_MAX_BYTES,
+    weigh=lambda cached: len(cached.body),
+)
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if if_none_match is None:
+        return False
+    tags = {tag.strip() for tag in if_none_match.split(',')}
+    return '*' in tags or etag in tags
+
+
+def list_cache_key(filters: dict, page: int, size: int, sort_by: str,
+                   sort_desc: bool, cursor: Optional[str]) -> tuple:
+    # search results are paged by offset, a cursor replaces the page otherwise
+    if filters.get('search'):
+        cursor = None
+    elif cursor:
+        page = 0
+    return ('posts', tuple(sorted(filters.items())), page, size, sort_by, sort_desc, cursor)
+
+
+def cache_response(key: Any, body: bytes, headers: Optional[dict] = None,
+                   post_id: Optional[int] = None, filters: Optional[dict] = None) -> CachedResponse:
+    cached = CachedResponse(
+        body=body,
+        etag=make_etag(body),
+        headers=headers or {},
+        post_id=post_id,
+        filters=filters,
+    )
+    posts_cache.set(key, cached)
+    return cached
+
+
+def to_response(cached: CachedResponse, if_none_match: Optional[str]) -> Response:
+    headers = {'ETag': cached.etag, **cached.headers}
+    if etag_matches(cached.etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type='application/json', headers=headers)
+
+
+def _listing_may_contain(filters: dict, post) -> bool:
+    """
+    Whether a listing with these filters may include the post.
+    Answers True whenever it cannot tell for sure.
+    """
+    if filters.get('search'):
+        return True
+    category_id = filters.get('category_id')
+    if category_id is not None and category_id != post.category_id:
+        return False
+    user_id = filters.get('user_id')
+    if user_id is not None and user_id != post.user_id:
+        return False
+    price_gte = filters.get('price__gte')
+    if price_gte is not None and (post.price is None or post.price < price_gte):
+        return False
+    price_lte = filters.get('price__lte')
+    if price_lte is not None and (post.price is None or post.price > price_lte):
+        return False
+    title = filters.get('title__ilike')
+    if title is not None and '%' not in title and '_' not in title:
+        if post.title is None or title.casefold() not in post.title.casefold():
+            return False
+    return True
+
+
+# batches larger than this drop all listings instead of the matching ones
+_MANY_POSTS = 32
+
+
+def _drop_posts(posts: list) -> None:
+    post_ids = {post.id for post in posts}
+    if len(posts) > _MANY_POSTS:
+        posts_cache.pop_if(
+            lambda cached: cached.filters is not None or cached.post_id in post_ids
+        )
+    else:
+        posts_cache.pop_if(
+            lambda cached: cached.post_id in post_ids
+            or (cached.filters is not None
+                and any(_listing_may_contain(cached.filters, post) for post in posts))
+        )
+
+
+def _post_summary(post) -> dict:
+    return {
+        'id': post.id,
+        'category_id': post.category_id,
+        'price': None if post.price is None else str(post.price),
+        'title': post.title,
+        'user_id': None if post.user_id is None else str(post.user_id),
+    }
+
+
+def _drop_broadcast_posts(summaries: Optional[list]) -> None:
+    if summaries is None:
+        posts_cache.clear()
+        return
+    _drop_posts([
+        SimpleNamespace(
+            id=summary['id'],
+            category_id=summary['category_id'],
+            price=None if summary['price'] is None else Decimal(summary['price']),
+            title=summary['title'],
+            user_id=None if summary['user_id'] is None else UUID(summary['user_id']),
+        )
+        for summary in summaries
+    ])
+
+
+def invalidate_post(post) -> None:
+    """
+    Drop the cached responses a created or deleted post appears in.
+    Every page of a matching listing is dropped, as the post shifts them all.
+    """
+    invalidate_posts([post])
+
+
+def invalidate_posts(posts: list) -> None:
+    """
+    Same as invalidate_post for many posts at once, in this process and
+    in the others. Large batches drop all listings rather than matching
+    each post against each listing, the other processes drop everything.
+    """
+    if not posts:
+        return
+    _drop_posts(posts)
+    broadcast.publish(
+        'posts', [_post_summary(post) for post in posts] if len(posts) <= _MANY_POSTS else None
+    )
+
+
+broadcast.subscribe('posts', _drop_broadcast_posts)
+broadcast.on_reset(posts_cache.clear)
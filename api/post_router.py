@@ -1,25 +1,56 @@
+import csv
+import io
 from logging import getLogger
-from typing import List
+from typing import AsyncIterator, List, Optional, Union
 
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Header, Query, Response
 from fastapi import HTTPException
 from fastapi import Depends
+from fastapi.responses import StreamingResponse
+from envparse import Env
+from pydantic import TypeAdapter
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 
 from database.db import get_db
 from database.models import User
-from database.schemas import CategoryCreate, ShowCategory, CreatePost, ShowPost, ShowPostDetail, DeletePostResponse
-from crud.post_crud import _create_new_category, _create_new_post, _get_list_posts, _get_post, _delete_post
+from database.schemas import (CategoryCreate, ShowCategory, CreatePost, ShowPost, ShowPostDetail, DeletePostResponse,
+                              BulkCreatePostsResponse, PostPage, ModerationDelete, ModerationDeleteResponse,
+                              PostFacets, PostBatch)
+from crud.post_crud import (_create_new_category, _create_new_post, _create_new_posts, _get_list_posts, _get_post,
+                            _get_post_summary, _delete_post, _delete_posts_in_batches, _stream_posts,
+                            _count_posts, _get_facets, _get_posts_by_ids, category_catalog)
 from crud.user_crud import get_current_user_from_token
 from api.user_router import _check_admin_role
+from api.post_cache import (cache_response, etag_matches, invalidate_post, invalidate_posts,
+                            list_cache_key, posts_cache, to_response)
 
-from utils import PostFilter
+from utils import POST_SORT_COLUMNS, PostFilter
 
 logger = getLogger(__name__)
 
+env = Env()
+
+# the most posts a single bulk request may create
+POSTS_BULK_MAX_ITEMS = env.int('POSTS_BULK_MAX_ITEMS', default=5000)
+# posts deleted per statement of a moderation sweep
+POSTS_MODERATION_BATCH_SIZE = env.int('POSTS_MODERATION_BATCH_SIZE', default=1000)
+# batches of a single moderation request, the client repeats it while has_more
+POSTS_MODERATION_MAX_BATCHES = env.int('POSTS_MODERATION_MAX_BATCHES', default=10)
+# the most posts a single batch lookup may return
+POSTS_BATCH_MAX_IDS = env.int('POSTS_BATCH_MAX_IDS', default=100)
+# rows fetched from the server-side cursor per chunk of an export
+POSTS_EXPORT_BATCH_SIZE = env.int('POSTS_EXPORT_BATCH_SIZE', default=1000)
+
+EXPORT_FIELDS = list(ShowPostDetail.model_fields)
+SORT_BY_PATTERN = '^(' + '|'.join(POST_SORT_COLUMNS) + ')$'
+
 router = APIRouter()
 
+post_details_adapter = TypeAdapter(List[ShowPostDetail])
+bulk_created_adapter = TypeAdapter(BulkCreatePostsResponse)
+post_batch_adapter = TypeAdapter(PostBatch)
+
 
 @router.post('/create_category', response_model=ShowCategory)
 async def create_category(body: CategoryCreate, 
@@ -34,43 +65,240 @@ async def create_category(body: CategoryCreate,
         raise HTTPException(status_code=503, detail=f'Database error: {err}')
     
 
+@router.get('/categories', response_model=List[ShowCategory])
+async def get_categories(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+):
+    # served from the in-process catalog, clients revalidate with the ETag
+    headers = {'ETag': category_catalog.etag, 'Cache-Control': 'public, max-age=60'}
+    if category_catalog.etag is None:
+        await category_catalog.refresh()
+        headers['ETag'] = category_catalog.etag
+    if etag_matches(category_catalog.etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return category_catalog.all()
+
+
 @router.post('/create_post', response_model=ShowPost)
 async def create_post(body: CreatePost, 
                       db: AsyncSession = Depends(get_db), 
                       author: User = Depends(get_current_user_from_token)):
     try:
-        return await _create_new_post(body, db, author)
+        post = await _create_new_post(body, db, author)
+        invalidate_post(post)
+        return post
+    except IntegrityError as err:
+        logger.error(err)
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    
+
+@router.post('/bulk', response_model=BulkCreatePostsResponse)
+async def create_posts_bulk(body: List[CreatePost],
+                            db: AsyncSession = Depends(get_db),
+                            author: User = Depends(get_current_user_from_token)):
+    if len(body) > POSTS_BULK_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f'At most {POSTS_BULK_MAX_ITEMS} posts can be created at once.')
+    try:
+        created, errors = await _create_new_posts(body, db, author)
     except IntegrityError as err:
         logger.error(err)
         raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    invalidate_posts(created)
+    # serialized once here instead of being revalidated against response_model
+    body = bulk_created_adapter.dump_json(
+        BulkCreatePostsResponse.model_construct(created=created, errors=errors)
+    )
+    return Response(content=body, media_type='application/json')
     
 
-@router.get('/', response_model=List[ShowPostDetail])
+async def _posts_response(
+    db: AsyncSession,
+    page: int,
+    size: int,
+    filter_params: PostFilter,
+    sort_by: str,
+    sort_desc: bool,
+    cursor: Optional[str],
+    search: Optional[str],
+    count: Optional[str],
+    envelope: bool,
+    if_none_match: Optional[str],
+) -> Response:
+    filters = {**filter_params.model_dump(exclude_none=True), 'search': search}
+    key = (list_cache_key(filters, page, size, sort_by, sort_desc, cursor), count, envelope)
+    cached = posts_cache.get(key)
+    if cached is not None:
+        return to_response(cached, if_none_match)
+    try:
+        posts, next_cursor = await _get_list_posts(
+            db=db, page=page, size=size, post_filter=filter_params,
+            sort_by=sort_by, sort_desc=sort_desc, cursor=cursor, search=search,
+        )
+        headers = {} if next_cursor is None else {'X-Next-Cursor': next_cursor}
+        total = total_mode = None
+        if count is not None:
+            total, total_mode = await _count_posts(db, filter_params, search, count)
+            headers['X-Total-Count'] = str(total)
+            headers['X-Total-Count-Mode'] = total_mode
+        if envelope:
+            body = PostPage(
+                items=posts,
+                page=page,
+                size=size,
+                total=total,
+                total_mode=total_mode,
+                pages=None if total is None or not size else -(-total // size),
+                next_cursor=next_cursor,
+            ).model_dump_json().encode()
+        else:
+            body = post_details_adapter.dump_json(posts)
+        cached = cache_response(key, body, headers, filters=filters)
+        return to_response(cached, if_none_match)
+    except IntegrityError as err:
+        logger.error(err)
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+
+
+COUNT_QUERY = Query(
+    None, pattern='^(exact|estimated|cached|auto)$',
+    description='Adds X-Total-Count: exact, estimated by the planner, cached exact or auto',
+)
+
+
+@router.get('/', response_model=Union[List[ShowPostDetail], PostPage])
 async def get_posts(
     db: AsyncSession = Depends(get_db),
     page: int = Query(0, ge=0),
-    size: int = Query(10, le=100),
+    size: int = Query(10, ge=1, le=100),
     filter_params: PostFilter = Depends(PostFilter),
-    sort_by: str = 'id',
+    sort_by: str = Query('id', pattern=SORT_BY_PATTERN),
     sort_desc: bool = False,
+    cursor: Optional[str] = Query(None, description='Value of X-Next-Cursor from the previous page, replaces page'),
+    search: Optional[str] = Query(None, max_length=256, description='Full-text search over title and content, ranked by relevance'),
+    count: Optional[str] = COUNT_QUERY,
+    envelope: bool = Query(False, description='Wrap the posts into a page with pagination metadata'),
+    if_none_match: Optional[str] = Header(None),
+    user: User = Depends(get_current_user_from_token)
+):
+    return await _posts_response(
+        db, page, size, filter_params, sort_by, sort_desc, cursor, search, count, envelope, if_none_match,
+    )
+
+
+@router.get('/mine', response_model=Union[List[ShowPostDetail], PostPage])
+async def get_my_posts(
+    db: AsyncSession = Depends(get_db),
+    page: int = Query(0, ge=0),
+    size: int = Query(10, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description='Value of X-Next-Cursor from the previous page, replaces page'),
+    count: Optional[str] = COUNT_QUERY,
+    envelope: bool = Query(False, description='Wrap the posts into a page with pagination metadata'),
+    if_none_match: Optional[str] = Header(None),
     user: User = Depends(get_current_user_from_token)
 ):
+    # newest first, read from the (user_id, id) index
+    return await _posts_response(
+        db, page, size, PostFilter(user_id=user.id), 'id', True, cursor, None, count, envelope, if_none_match,
+    )
+      
+
+@router.get('/facets', response_model=PostFacets)
+async def get_post_facets(
+    db: AsyncSession = Depends(get_db),
+    filter_params: PostFilter = Depends(PostFilter),
+    if_none_match: Optional[str] = Header(None),
+    user: User = Depends(get_current_user_from_token)
+):
+    filters = filter_params.model_dump(exclude_none=True)
+    # unfiltered facets are kept in memory, filtered ones are cached like listings
+    key = ('facets', tuple(sorted(filters.items())))
+    cached = posts_cache.get(key) if filters else None
+    if cached is not None:
+        return to_response(cached, if_none_match)
     try:
-        return await _get_list_posts(db=db, page=page, size=size, post_filter=filter_params, sort_by=sort_by, sort_desc=sort_desc)
+        facets = await _get_facets(db, filter_params)
     except IntegrityError as err:
         logger.error(err)
         raise HTTPException(status_code=503, detail=f'Database error: {err}')
-      
+    body = facets.model_dump_json().encode()
+    if not filters:
+        return Response(content=body, media_type='application/json')
+    return to_response(cache_response(key, body, filters=filters), if_none_match)
+
+
+async def _export_ndjson(post_filter: PostFilter) -> AsyncIterator[bytes]:
+    async for posts in _stream_posts(post_filter, POSTS_EXPORT_BATCH_SIZE):
+        yield b''.join(post.model_dump_json().encode() + b'\n' for post in posts)
+
+
+async def _export_csv(post_filter: PostFilter) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    yield buffer.getvalue().encode()
+    async for posts in _stream_posts(post_filter, POSTS_EXPORT_BATCH_SIZE):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(post.model_dump(mode='json') for post in posts)
+        yield buffer.getvalue().encode()
+
+
+@router.get('/export')
+async def export_posts(
+    filter_params: PostFilter = Depends(PostFilter),
+    export_format: str = Query('ndjson', alias='format', pattern='^(ndjson|csv)$'),
+    user: User = Depends(get_current_user_from_token)
+):
+    # each chunk is sent only after the client has taken the previous one,
+    # a disconnect cancels the generator which closes the cursor
+    if export_format == 'csv':
+        return StreamingResponse(
+            _export_csv(filter_params),
+            media_type='text/csv',
+            headers={'Content-Disposition': 'attachment; filename="posts.csv"'},
+        )
+    return StreamingResponse(_export_ndjson(filter_params), media_type='application/x-ndjson')
+
+
+@router.get('/batch', response_model=PostBatch)
+async def get_posts_batch(
+    ids: List[int] = Query(..., description='Ids of the posts, the order is kept'),
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(get_current_user_from_token)
+):
+    if len(ids) > POSTS_BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=422,
+            detail=f'At most {POSTS_BATCH_MAX_IDS} posts can be requested at once.')
+    try:
+        posts, missing = await _get_posts_by_ids(ids, db)
+    except IntegrityError as err:
+        logger.error(err)
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    body = post_batch_adapter.dump_json(PostBatch.model_construct(items=posts, missing=missing))
+    return Response(content=body, media_type='application/json')
+
 
 @router.get('/{post_id}', response_model=ShowPostDetail)
-async def get_post(post_id: int, db: AsyncSession = Depends(get_db), user: User = Depends(get_current_user_from_token)):
+async def get_post(post_id: int, db: AsyncSession = Depends(get_db),
+                   if_none_match: Optional[str] = Header(None),
+                   user: User = Depends(get_current_user_from_token)):
+    key = ('post', post_id)
+    cached = posts_cache.get(key)
+    if cached is not None:
+        return to_response(cached, if_none_match)
     try:
         post = await _get_post(post_id, db)
         if not post:
             raise HTTPException(
                 status_code=404,
                 detail=f'Post number {post_id} does not exist.')
-        return post.as_show_model()
+        cached = cache_response(key, post.model_dump_json().encode(), post_id=post_id)
+        return to_response(cached, if_none_match)
     except IntegrityError as err:
         logger.error(err)
         raise HTTPException(status_code=503, detail=f'Database error: {err}')
@@ -82,19 +310,44 @@ async def delete_post(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_from_token),
 ):
-    post = await _get_post(post_id, db)
-    if not post:
+    try:
+        post = await _delete_post(post_id, db, current_user)
+    except IntegrityError as err:
+        logger.error(err)
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    if post is None:
+        # only failed deletes pay for finding out why
+        if await _get_post_summary(post_id, db) is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f'Post number {post_id} does not exist.')
+        _check_admin_role(current_user)
+        # an admin's delete matches any post, so it only misses in a race
         raise HTTPException(
-            status_code=404,
-            detail=f'Post number {post_id} does not exist.') 
+            status_code=409,
+            detail=f'Post number {post_id} was not deleted, try again.')
+    invalidate_post(post)
+    return DeletePostResponse(deleted_post_id=post_id)
 
+
+@router.delete('/moderation', response_model=ModerationDeleteResponse)
+async def delete_posts_for_moderation(
+    body: ModerationDelete,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user_from_token),
+):
+    # Only an administrator can moderate posts
+    _check_admin_role(current_user)
+    if body.ids is None and body.user_id is None and body.category_id is None:
+        raise HTTPException(
+            status_code=422, detail='Specify ids, user_id or category_id of the posts.')
     try:
-        if current_user.id == post.user_id:
-            await _delete_post(post_id, db)
-        else:
-            _check_admin_role(current_user)
-            await _delete_post(post_id, db)
-        return DeletePostResponse(deleted_post_id=post_id)
+        deleted, has_more = await _delete_posts_in_batches(
+            db, ids=body.ids, user_id=body.user_id, category_id=body.category_id,
+            batch_size=POSTS_MODERATION_BATCH_SIZE, max_batches=POSTS_MODERATION_MAX_BATCHES,
+            on_batch=invalidate_posts,
+        )
     except IntegrityError as err:
         logger.error(err)
-        raise HTTPException(status_code=503, detail=f'Database error: {err}')
\ No newline at end of file
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    return ModerationDeleteResponse(deleted=deleted, has_more=has_more)
@@ -3,18 +3,23 @@ from datetime import timedelta
 from uuid import UUID
 
 from fastapi import APIRouter
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Response, status
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from fastapi.security import OAuth2PasswordRequestForm
+from pydantic import BaseModel
+from envparse import Env
 
 
 
 from database.db import get_db
-from database.schemas import ShowUser, UserCreate, Token, UpdatedUserResponse
+from database.schemas import (ShowUser, UserCreate, Token, UpdatedUserResponse,
+                              RoleChangeRequest, RoleChangeResponse, RefreshTokenRequest)
 from crud.user_crud import (_create_new_user, authenticate_user, create_access_token, 
-                            get_current_user_from_token, _get_user_by_id, _update_user)
+                            get_current_user_from_token, _change_admin_role,
+                            get_auth_cache_stats, create_refresh_token, _rotate_refresh_token,
+                            _revoke_refresh_token)
 
 from crud.user_crud import ACCESS_TOKEN_EXPIRE_MINUTES
 
@@ -22,17 +27,37 @@ from database.models import User
 
 logger = getLogger(__name__)
 
+env = Env()
+
+# the most users a single bulk role change may touch, all of them are
+# updated by one statement with a bind parameter per id
+USERS_ROLE_CHANGE_MAX_IDS = env.int('USERS_ROLE_CHANGE_MAX_IDS', default=1000)
+
 router = APIRouter()
 
 
+def _json_response(model: BaseModel) -> Response:
+    # serialized once here instead of being revalidated against response_model
+    return Response(content=model.model_dump_json(), media_type='application/json')
+
+
 @router.post('/sign-up', response_model=ShowUser)
-async def create_user(body: UserCreate, db: AsyncSession = Depends(get_db)) -> ShowUser:
+async def create_user(body: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
-        return await _create_new_user(body, db)
+        user = await _create_new_user(body, db)
     except IntegrityError as err:
         logger.error(err)
         raise HTTPException(status_code=503, detail=f"Database error: {err}")
+    return _json_response(user)
+
+
 
+def _issue_access_token(email: str) -> str:
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    return create_access_token(
+        data={'sub': email, 'other_custom_data': [1, 2, 3, 4]},
+        expires_delta=access_token_expires,
+    )
 
 
 @router.post('/token', response_model=Token)
@@ -45,12 +70,31 @@ async def login_for_access_token(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Incorrect username or password'
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={'sub': user.email, 'other_custom_data': [1, 2, 3, 4]},
-        expires_delta=access_token_expires,
-    )
-    return {'access_token': access_token, 'token_type': 'bearer'}
+    access_token = _issue_access_token(user.email)
+    refresh_token = await create_refresh_token(user.id, db)
+    return _json_response(Token.model_construct(
+        access_token=access_token, token_type='bearer', refresh_token=refresh_token))
+
+
+@router.post('/token/refresh', response_model=Token)
+async def refresh_access_token(body: RefreshTokenRequest, db: AsyncSession = Depends(get_db)):
+    # no password here, so no bcrypt: the refresh token is checked by its hash
+    rotated = await _rotate_refresh_token(body.refresh_token, db)
+    if rotated is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='Invalid refresh token'
+        )
+    email, refresh_token = rotated
+    access_token = _issue_access_token(email)
+    return _json_response(Token.model_construct(
+        access_token=access_token, token_type='bearer', refresh_token=refresh_token))
+
+
+@router.post('/token/revoke', status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_refresh_token(body: RefreshTokenRequest, db: AsyncSession = Depends(get_db)):
+    await _revoke_refresh_token(body.refresh_token, db)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
 # @router.get("/test_auth_endpoint")
@@ -74,21 +118,24 @@ def _check_not_yourself(current_user, user_id):
         )
 
 
-def _check_user_for_promotion_or_revoke(user, promotion=True):
-    if user is None:
+def _raise_for_unchanged_role(user_id, changed, not_found, inactive, promotion=True):
+    if not_found:
         raise HTTPException(
             status_code=404, detail=f'User not found.'
         )
-    if promotion:    
-        if user.is_admin:
+    if inactive:
+        raise HTTPException(
+            status_code=409, detail=f'User with id {user_id} is not active.'
+        )
+    if not changed:
+        if promotion:
             raise HTTPException(
                 status_code=409,
-                detail=f'User with id {user.id} already promoted to admin',
+                detail=f'User with id {user_id} already promoted to admin',
             )
-    if not user.is_admin:
         raise HTTPException(
             status_code=409, 
-            detail=f"User with id {user.id} has no admin privileges."
+            detail=f"User with id {user_id} has no admin privileges."
         )
     
 
@@ -103,21 +150,13 @@ async def grant_admin_privilege(
 
     _check_not_yourself(current_user, user_id)
 
-    user_for_promotion = await _get_user_by_id(user_id, db)
-
-    _check_user_for_promotion_or_revoke(user_for_promotion, True)
-
-    updated_user_params = {
-        'roles': user_for_promotion.adding_admin_role()
-    }
     try:
-        updated_user_id = await _update_user(
-            updated_user_params=updated_user_params, db=db, user_id=user_id
-        )
+        changed, _, not_found, inactive = await _change_admin_role([user_id], True, db)
     except IntegrityError as err:
         logger.error(err)
         raise HTTPException(status_code=503, detail=f'Database error: {err}')
-    return UpdatedUserResponse(updated_user_id=updated_user_id)
+    _raise_for_unchanged_role(user_id, changed, not_found, inactive, True)
+    return _json_response(UpdatedUserResponse.model_construct(updated_user_id=user_id))
 
 
 @router.delete('/admin_privilege', response_model=UpdatedUserResponse)
@@ -130,18 +169,57 @@ async def revoke_admin_privilege(
 
     _check_not_yourself(current_user, user_id)
 
-    user_for_revoke_admin_privileges = await _get_user_by_id(user_id, db)
+    try:
+        changed, _, not_found, inactive = await _change_admin_role([user_id], False, db)
+    except IntegrityError as err:
+        logger.error(err)
+        raise HTTPException(status_code=503, detail=f"Database error: {err}")
+    _raise_for_unchanged_role(user_id, changed, not_found, inactive, False)
+    return _json_response(UpdatedUserResponse.model_construct(updated_user_id=user_id))
 
-    _check_user_for_promotion_or_revoke(user_for_revoke_admin_privileges, False)
 
-    updated_user_params = {
-        "roles": user_for_revoke_admin_privileges.remove_admin_role()
-    }
+async def _change_admin_role_in_bulk(body: RoleChangeRequest, grant: bool, db: AsyncSession, current_user):
+    _check_admin_role(current_user)
+    if len(body.user_ids) > USERS_ROLE_CHANGE_MAX_IDS:
+        raise HTTPException(
+            status_code=422,
+            detail=f'At most {USERS_ROLE_CHANGE_MAX_IDS} users can be changed at once.')
+    user_ids = list(dict.fromkeys(body.user_ids))
+    # privileges of itself are never managed, the id is reported as skipped
+    own = [user_id for user_id in user_ids if user_id == current_user.id]
+    others = [user_id for user_id in user_ids if user_id != current_user.id]
     try:
-        updated_user_id = await _update_user(
-            updated_user_params=updated_user_params, db=db, user_id=user_id
+        changed, skipped, not_found, inactive = (
+            await _change_admin_role(others, grant, db) if others else ([], [], [], [])
         )
     except IntegrityError as err:
         logger.error(err)
-        raise HTTPException(status_code=503, detail=f"Database error: {err}")
-    return UpdatedUserResponse(updated_user_id=updated_user_id)
\ No newline at end of file
+        raise HTTPException(status_code=503, detail=f'Database error: {err}')
+    return _json_response(RoleChangeResponse.model_construct(
+        changed=changed, skipped=own + skipped, not_found=not_found, inactive=inactive))
+
+
+@router.patch('/admin_privilege/bulk', response_model=RoleChangeResponse)
+async def grant_admin_privilege_in_bulk(
+    body: RoleChangeRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user_from_token),
+):
+    return await _change_admin_role_in_bulk(body, True, db, current_user)
+
+
+@router.delete('/admin_privilege/bulk', response_model=RoleChangeResponse)
+async def revoke_admin_privilege_in_bulk(
+    body: RoleChangeRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user_from_token),
+):
+    return await _change_admin_role_in_bulk(body, False, db, current_user)
+
+
+@router.get('/auth_cache')
+async def auth_cache_stats(
+    current_user: User = Depends(get_current_user_from_token),
+):
+    _check_admin_role(current_user)
+    return get_auth_cache_stats()
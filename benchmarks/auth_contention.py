@@ -0,0 +1,102 @@
+"""
+Latency of GET /posts/ while /user/token is under concurrent load.
+
+Runs against an already started service. All login workers come from
+one address, so start it without the per-client limits of admission
+control, otherwise nearly every login is a cheap 429:
+
+    ADMISSION_LIMITS='{"/user/token": {"concurrency": 4, "queue": 16, "queue_timeout": 2.0}}' python main.py
+    python -m benchmarks.auth_contention --base-url http://127.0.0.1:8000
+
+The script measures /posts/ alone first and then with login workers
+hammering /user/token, and prints both results as JSON together with
+the status codes the logins got.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+
+import httpx
+
+from benchmarks.stats import summary
+
+
+async def create_account(client):
+    email = f'bench-{uuid.uuid4().hex[:12]}@example.com'
+    password = 'bench-password'
+    response = await client.post('/user/sign-up', json={
+        'name': 'Bench', 'surname': 'Bench', 'email': email, 'password': password,
+    })
+    response.raise_for_status()
+    return email, password
+
+
+async def login(client, email, password):
+    response = await client.post('/user/token', data={'username': email, 'password': password})
+    response.raise_for_status()
+    return response.json()['access_token']
+
+
+async def read_posts(client, token, duration, samples):
+    headers = {'Authorization': f'Bearer {token}'}
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await client.get('/posts/', params={'size': 10}, headers=headers)
+        response.raise_for_status()
+        samples.append((time.perf_counter() - started) * 1000)
+
+
+async def hammer_login(client, email, password, stop, statuses):
+    while not stop.is_set():
+        response = await client.post('/user/token', data={'username': email, 'password': password})
+        statuses[response.status_code] += 1
+
+
+async def run(args):
+    limits = httpx.Limits(max_connections=args.logins + args.readers + 4)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=60) as client:
+        email, password = await create_account(client)
+        token = await login(client, email, password)
+
+        idle = []
+        await asyncio.gather(*(
+            read_posts(client, token, args.duration, idle) for _ in range(args.readers)
+        ))
+
+        loaded = []
+        stop = asyncio.Event()
+        statuses = Counter()
+        logins = [
+            asyncio.create_task(hammer_login(client, email, password, stop, statuses))
+            for _ in range(args.logins)
+        ]
+        await asyncio.gather(*(
+            read_posts(client, token, args.duration, loaded) for _ in range(args.readers)
+        ))
+        stop.set()
+        await asyncio.gather(*logins, return_exceptions=True)
+
+    return {
+        'posts_without_login_load': summary(idle),
+        'posts_with_login_load': summary(loaded),
+        'concurrent_logins': args.logins,
+        'login_statuses': {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per phase')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--logins', type=int, default=16)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Regression check of the token buckets of admission control.
+
+    python -m benchmarks.rate_limits
+
+Drives RouteLimiter with a simulated clock, no server or database is
+needed: one client sends --request-rate requests per second for
+--duration seconds against ip_rate/ip_burst. A bucket admits at most
+ip_burst + ip_rate * duration requests, the exit code is 1 when more
+were admitted, e.g. because a throttled client's bucket was forgotten
+and came back full.
+"""
+import argparse
+import json
+import sys
+from unittest import mock
+
+import admission
+import utils
+from admission import Rejected, RouteLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def simulate(ip_rate: float, ip_burst: float, request_rate: float, duration: float) -> int:
+    clock = Clock()
+    admitted = 0
+    with mock.patch.object(admission.time, 'monotonic', clock.monotonic), \
+            mock.patch.object(utils.time, 'monotonic', clock.monotonic):
+        limiter = RouteLimiter('/bench', ip_rate=ip_rate, ip_burst=ip_burst)
+        for step in range(int(duration * request_rate)):
+            clock.now = 1000.0 + step / request_rate
+            try:
+                limiter._check_rate('127.0.0.1')
+                admitted += 1
+            except Rejected:
+                pass
+    return admitted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regression check of the admission token buckets.')
+    parser.add_argument('--ip-rate', type=float, default=1.0)
+    parser.add_argument('--ip-burst', type=float, default=10.0)
+    parser.add_argument('--request-rate', type=float, default=20.0)
+    parser.add_argument('--duration', type=float, default=30.0)
+    args = parser.parse_args()
+
+    admitted = simulate(args.ip_rate, args.ip_burst, args.request_rate, args.duration)
+    allowed = int(args.ip_burst + args.ip_rate * args.duration)
+    print(json.dumps({'admitted': admitted, 'allowed': allowed}, indent=2))
+    if admitted > allowed:
+        print(f'RATE LIMIT REGRESSION admitted {admitted} > {allowed}', file=sys.stderr)
+    sys.exit(1 if admitted > allowed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Requests per second on one core of GET /posts/?size=100, serialization only.
+
+    python -m benchmarks.serialization --requests 2000
+
+The database is replaced by 100 prepared rows, so the numbers isolate
+what the app does with them. 'before' validates each ShowPostDetail and
+lets FastAPI revalidate and encode the list through response_model,
+'after' is the path the post routes use now: DTOs built from the rows
+without validation and serialized once into the response body.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import namedtuple
+from decimal import Decimal
+from typing import List
+
+import httpx
+from fastapi import FastAPI, Response
+
+from api.post_router import post_details_adapter
+from crud.post_crud import _rows_to_post_details, category_catalog
+from database.schemas import ShowCategory, ShowPostDetail
+
+Row = namedtuple('Row', 'id title content price user_email category_id')
+
+ROWS = [
+    Row(i, f'post {i}', 'lorem ipsum dolor sit amet ' * 80, Decimal('1234.50'), f'user{i}@example.com', 1)
+    for i in range(100)
+]
+
+
+def build_apps():
+    category_catalog.add(ShowCategory(id=1, title='category', description='benchmark'))
+
+    before = FastAPI()
+
+    @before.get('/posts/', response_model=List[ShowPostDetail])
+    async def posts_before():
+        return [
+            ShowPostDetail(
+                id=row.id,
+                title=row.title,
+                content=row.content,
+                price=row.price,
+                user_email=row.user_email,
+                category_name=category_catalog.get(row.category_id).title,
+            )
+            for row in ROWS
+        ]
+
+    after = FastAPI()
+
+    @after.get('/posts/')
+    async def posts_after():
+        posts = await _rows_to_post_details(ROWS)
+        return Response(content=post_details_adapter.dump_json(posts), media_type='application/json')
+
+    return before, after
+
+
+async def measure(app, requests: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for _ in range(min(100, requests)):
+            await client.get('/posts/', params={'size': 100})
+        started = time.perf_counter()
+        for _ in range(requests):
+            response = await client.get('/posts/', params={'size': 100})
+        elapsed = time.perf_counter() - started
+    assert len(response.json()) == len(ROWS)
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serialization benchmark of the post listing.')
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    before, after = build_apps()
+    rps_before = asyncio.run(measure(before, args.requests))
+    rps_after = asyncio.run(measure(after, args.requests))
+    print(json.dumps({
+        'endpoint': 'GET /posts/?size=100',
+        'rps_per_core_before': round(rps_before, 1),
+        'rps_per_core_after': round(rps_after, 1),
+        'speedup': round(rps_after / rps_before, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Per-call cost of preparing the hot statements for execution.
+
+    python -m benchmarks.statements --calls 20000
+
+Measures what happens in the process before a statement reaches asyncpg:
+building the construct, generating its cache key, looking it up in the
+compiled cache and binding the parameters, the same steps as
+Connection.execute. No database is needed. 'before' builds the statement
+on every call as the DAL did, 'after' reuses the statements of
+database/dals.py and crud/post_crud.py.
+"""
+import argparse
+import json
+import time
+from decimal import Decimal
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql.asyncpg import dialect as asyncpg_dialect
+from sqlalchemy.util import LRUCache
+
+from crud.post_crud import _POST_BY_ID, _list_posts_query, _post_detail_query
+from database.dals import _USER_BY_EMAIL
+from database.models import Post, User
+from utils import PostFilter
+
+DIALECT = asyncpg_dialect()
+FILTER = PostFilter(category_id=3, price__gte=Decimal('100'))
+
+
+def user_by_email_before():
+    return select(User).where(User.email == 'bench@example.com'), {}
+
+
+def user_by_email_after():
+    return _USER_BY_EMAIL, {'email': 'bench@example.com'}
+
+
+def post_before():
+    return _post_detail_query().where(Post.id == 42), {}
+
+
+def post_after():
+    return _POST_BY_ID, {'post_id': 42}
+
+
+def list_before():
+    query = (
+        _post_detail_query(Post.price.label('sort_key'))
+        .limit(20)
+        .offset(40)
+    )
+    return FILTER.filter(query).order_by(Post.price, Post.id), {}
+
+
+def list_after():
+    return _list_posts_query(20, FILTER, page=2, sort_by='price')
+
+
+CASES = {
+    'UserDAL.get_user_by_email': (user_by_email_before, user_by_email_after),
+    '_get_post': (post_before, post_after),
+    '_get_list_posts': (list_before, list_after),
+}
+
+
+def measure(build, calls: int) -> dict:
+    cache = LRUCache(500)
+    hits = 0
+    started = time.perf_counter()
+    for _ in range(calls):
+        statement, params = build()
+        compiled, extracted, cache_hit = statement._compile_w_cache(
+            DIALECT, compiled_cache=cache, column_keys=sorted(params),
+        )
+        compiled.construct_params(params, extracted_parameters=extracted)
+        hits += cache_hit.name == 'CACHE_HIT'
+    elapsed = time.perf_counter() - started
+    return {'us_per_call': round(elapsed / calls * 1e6, 1), 'cache_hit_ratio': round(hits / calls, 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-call overhead of the hot statements.')
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+    result = {}
+    for name, (before, after) in CASES.items():
+        result[name] = {'before': measure(before, args.calls), 'after': measure(after, args.calls)}
+        result[name]['speedup'] = round(
+            result[name]['before']['us_per_call'] / result[name]['after']['us_per_call'], 2
+        )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import statistics
+from typing import List, Optional
+
+"""
+Block with latency statistics shared by the benchmarks.
+"""
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summary(samples: List[float], duration: Optional[float] = None, errors: int = 0) -> dict:
+    result = {
+        'requests': len(samples),
+        'errors': errors,
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'mean_ms': statistics.fmean(samples) if samples else None,
+    }
+    if duration:
+        result['rps'] = len(samples) / duration
+    return result
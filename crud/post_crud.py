@@ -1,16 +1,240 @@
-from typing import List
+import asyncio
+import bisect
+import hashlib
+import json
+import time
+from collections import Counter
+from logging import getLogger
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
 from decimal import Decimal
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import delete, desc
-from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy import Integer, Select, and_, any_, bindparam, cast, delete, desc, func, insert, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, REGCONFIG, array
+from sqlalchemy.exc import SQLAlchemyError
+from fastapi import HTTPException
 from fastapi_filter import FilterDepends
+from envparse import Env
 
-from utils import PostFilter
+from utils import POST_SORT_COLUMNS, Explain, PostFilter, TTLCache, decode_cursor, encode_cursor, plan_of
 
-from database.models import Category, Post, User
-from database.schemas import CategoryCreate, ShowCategory, CreatePost, ShowPost, ShowPostDetail
-from database.db import get_db
+from database.models import SEARCH_CONFIG, Category, Post, User
+from database.schemas import (CategoryCreate, ShowCategory, CreatePost, ShowPost, ShowPostDetail,
+                              BulkPostError, CategoryFacet, PriceBucket, PostFacets)
+from database.db import async_session, get_db
+from database.notify import broadcast
+
+logger = getLogger(__name__)
+
+env = Env()
+
+# rows per multi-row INSERT of the bulk creation
+POSTS_BULK_INSERT_BATCH = 500
+# the largest value posts.price (NUMERIC(10, 2)) can hold
+MAX_PRICE = Decimal('99999999.99')
+
+# variables to configure the total count of listings
+POSTS_EXACT_COUNT_LIMIT = env.int('POSTS_EXACT_COUNT_LIMIT', default=10000)
+POSTS_COUNT_CACHE_TTL_SECONDS = env.float('POSTS_COUNT_CACHE_TTL_SECONDS', default=60.0)
+
+# exact counts, keyed by the filters
+count_cache = TTLCache(maxsize=1024, ttl=POSTS_COUNT_CACHE_TTL_SECONDS)
+
+# the listings the indexes of posts are designed for:
+# (filtered fields, sort_by) -> indexes that may serve the listing
+LISTING_INDEXES = {
+    ((), 'id'): ('posts_pkey', 'ix_posts_id'),
+    ((), 'price'): ('ix_posts_price_id',),
+    ((), 'title'): ('ix_posts_title_id',),
+    (('price',), 'price'): ('ix_posts_price_id',),
+    (('category_id',), 'id'): ('ix_posts_category_id_id',),
+    (('category_id',), 'price'): ('ix_posts_category_id_price_id',),
+    (('category_id',), 'title'): ('ix_posts_category_id_title_id',),
+    (('category_id', 'price'), 'price'): ('ix_posts_category_id_price_id',),
+    (('user_id',), 'id'): ('ix_posts_user_id_id',),
+}
+
+# lower bounds of the price histogram buckets, comma separated and ascending
+POSTS_FACET_PRICE_BOUNDS = [
+    Decimal(bound.strip())
+    for bound in env.str('POSTS_FACET_PRICE_BOUNDS', default='0,10,50,100,500,1000,5000,10000').split(',')
+    if bound.strip()
+]
+# bounds staleness of the unfiltered facets caused by writes of other processes
+POSTS_FACETS_REFRESH_SECONDS = env.float('POSTS_FACETS_REFRESH_SECONDS', default=60.0)
+# reloads of the category catalog caused by unknown ids sent by clients, at most one per interval
+CATEGORY_CATALOG_MISS_REFRESH_SECONDS = env.float('CATEGORY_CATALOG_MISS_REFRESH_SECONDS', default=5.0)
+
+
+class CategoryCatalog:
+    """
+    Versioned in-process snapshot of the categories table.
+    Categories change rarely, so listings and post validation read them
+    from memory. Categories created by other processes arrive through
+    broadcast, an unknown id triggers a reload as well.
+    """
+    def __init__(self):
+        self.version = 0
+        self.etag: Optional[str] = None
+        self._categories: Dict[int, ShowCategory] = {}
+        self._miss_refreshed_at: Optional[float] = None
+
+    def _publish(self, categories: Dict[int, ShowCategory]) -> None:
+        payload = json.dumps(
+            [category.model_dump() for category in sorted(categories.values(), key=lambda c: c.id)],
+            separators=(',', ':'),
+        )
+        etag = '"' + hashlib.sha1(payload.encode()).hexdigest() + '"'
+        self._categories = categories
+        if etag != self.etag:
+            self.etag = etag
+            self.version += 1
+
+    async def refresh(self) -> None:
+        async with async_session() as db:
+            # a lagging replica would miss the category that triggered the refresh
+            db.info['use_primary'] = True
+            result = await db.execute(
+                select(Category.id, Category.title, Category.description)
+            )
+            self._publish({
+                row.id: ShowCategory(id=row.id, title=row.title, description=row.description)
+                for row in result.all()
+            })
+
+    async def load(self) -> None:
+        """Startup hook, the app still starts if the table is not there yet."""
+        try:
+            await self.refresh()
+        except (SQLAlchemyError, OSError) as err:
+            logger.warning('Category catalog was not loaded: %s', err)
+
+    def add(self, category: ShowCategory) -> None:
+        self._publish({**self._categories, category.id: category})
+
+    def invalidate(self) -> None:
+        """Makes the next GET /categories reload the catalog."""
+        self.etag = None
+
+    async def ensure(self, category_ids: Iterable[int]) -> None:
+        """Reloads on a miss, for ids read from the database, which exist."""
+        if any(category_id not in self._categories for category_id in category_ids):
+            await self.refresh()
+
+    async def ensure_requested(self, category_ids: Iterable[int]) -> None:
+        """
+        Same as ensure for ids sent by clients, which may not exist, so
+        misses reload at most once per CATEGORY_CATALOG_MISS_REFRESH_SECONDS.
+        """
+        if all(category_id in self._categories for category_id in category_ids):
+            return
+        now = time.monotonic()
+        if (
+            self._miss_refreshed_at is not None
+            and now - self._miss_refreshed_at < CATEGORY_CATALOG_MISS_REFRESH_SECONDS
+        ):
+            return
+        # taken before the reload, so concurrent misses do not start another one
+        self._miss_refreshed_at = now
+        await self.refresh()
+
+    def get(self, category_id: int) -> Optional[ShowCategory]:
+        return self._categories.get(category_id)
+
+    def all(self) -> List[ShowCategory]:
+        return sorted(self._categories.values(), key=lambda category: category.id)
+
+
+category_catalog = CategoryCatalog()
+broadcast.subscribe('category', lambda data: category_catalog.add(ShowCategory(**data)))
+broadcast.on_reset(category_catalog.invalidate)
+
+
+def _price_bucket(price: Optional[Decimal]) -> Optional[int]:
+    """Same numbering as width_bucket(price, POSTS_FACET_PRICE_BOUNDS)."""
+    if price is None:
+        return None
+    return bisect.bisect_right(POSTS_FACET_PRICE_BOUNDS, price)
+
+
+def _facets_query():
+    bucket = func.width_bucket(Post.price, array(POSTS_FACET_PRICE_BOUNDS)).label('bucket')
+    return (
+        select(Post.category_id, bucket, func.count().label('count'))
+        .group_by(Post.category_id, bucket)
+    )
+
+
+class FacetCounts:
+    """
+    Post counts of the whole table by (category_id, price bucket).
+    Loaded with the facets query and then kept up to date by the writes
+    of this process, a periodic reload picks up the writes of others.
+    """
+    def __init__(self):
+        self.loaded_at: Optional[float] = None
+        self._counts: Counter = Counter()
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> None:
+        async with async_session() as db:
+            # counts from a lagging replica would miss posts already counted by add()
+            db.info['use_primary'] = True
+            result = await db.execute(_facets_query())
+            self._counts = Counter({
+                (row.category_id, row.bucket): row.count for row in result.all()
+            })
+        self.loaded_at = time.monotonic()
+
+    async def load(self) -> None:
+        """Startup hook, the app still starts if the table is not there yet."""
+        try:
+            await self.refresh()
+        except (SQLAlchemyError, OSError) as err:
+            logger.warning('Post facets were not loaded: %s', err)
+
+    def is_stale(self) -> bool:
+        return (
+            self.loaded_at is None
+            or time.monotonic() - self.loaded_at > POSTS_FACETS_REFRESH_SECONDS
+        )
+
+    async def current(self) -> list:
+        """
+        The counts, reloaded by a single background task once stale.
+        Requests keep getting the previous counts meanwhile and only wait
+        when nothing has been loaded yet.
+        """
+        if self.is_stale():
+            if self._refreshing is None or self._refreshing.done():
+                self._refreshing = asyncio.create_task(self.refresh())
+                self._refreshing.add_done_callback(self._log_failure)
+            if self.loaded_at is None:
+                await asyncio.shield(self._refreshing)
+        return self.items()
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning('Post facets were not refreshed: %s', task.exception())
+
+    def add(self, posts) -> None:
+        for post in posts:
+            self._counts[(post.category_id, _price_bucket(post.price))] += 1
+
+    def remove(self, posts) -> None:
+        for post in posts:
+            key = (post.category_id, _price_bucket(post.price))
+            self._counts[key] -= 1
+            if self._counts[key] <= 0:
+                del self._counts[key]
+
+    def items(self):
+        return list(self._counts.items())
+
+
+facet_counts = FacetCounts()
 
 
 async def _create_new_category(body: CategoryCreate, db: AsyncSession) -> ShowCategory:
@@ -21,25 +245,32 @@ async def _create_new_category(body: CategoryCreate, db: AsyncSession) -> ShowCa
         )
         db.add(db_category)
         await db.flush()
-        return ShowCategory(
+        category = ShowCategory(
             id=db_category.id,
             title=db_category.title,
             description=db_category.description,
         )
+    category_catalog.add(category)
+    broadcast.publish('category', category.model_dump())
+    return category
     
 
 async def _create_new_post(body: CreatePost, db: AsyncSession, author: User) -> ShowPost:
+    await category_catalog.ensure_requested([body.category_id])
+    error = _check_post_body(body)
+    if error is not None:
+        raise HTTPException(status_code=422, detail=error)
     async with db.begin():
         db_post = Post(
             title=body.title,
             content=body.content,
             price=Decimal(body.price),
             category_id=body.category_id,
-            author=author,
+            user_id=author.id,
         )
         db.add(db_post)
         await db.flush()
-        return ShowPost(
+        post = ShowPost(
             id=db_post.id,
             title=db_post.title,
             content=db_post.content,
@@ -47,63 +278,482 @@ async def _create_new_post(body: CreatePost, db: AsyncSession, author: User) ->
             user_id=db_post.user_id,
             category_id=db_post.category_id
         )
+    facet_counts.add([post])
+    return post
     
 
+def _check_post_body(body: CreatePost) -> Optional[str]:
+    """Returns why the post cannot be created, if it cannot."""
+    if category_catalog.get(body.category_id) is None:
+        return f'Category number {body.category_id} does not exist.'
+    if body.price < 0 or body.price > MAX_PRICE:
+        return f'Price must be between 0 and {MAX_PRICE}.'
+    if body.price.as_tuple().exponent < -2:
+        return 'Price must have at most two decimal places.'
+    if len(body.title) > Post.title.type.length:
+        return f'Title must be at most {Post.title.type.length} characters long.'
+
+
+async def _create_new_posts(
+        bodies: List[CreatePost], db: AsyncSession, author: User
+) -> Tuple[List[ShowPost], List[BulkPostError]]:
+    """
+    Creates the valid posts with multi-row INSERTs in one transaction,
+    invalid ones are reported by their index instead of failing the batch.
+    """
+    await category_catalog.ensure_requested({body.category_id for body in bodies})
+    rows, errors = [], []
+    for index, body in enumerate(bodies):
+        error = _check_post_body(body)
+        if error is not None:
+            errors.append(BulkPostError(index=index, detail=error))
+            continue
+        rows.append({
+            'title': body.title,
+            'content': body.content,
+            'price': body.price,
+            'category_id': body.category_id,
+            'user_id': author.id,
+        })
+
+    created = []
+    if rows:
+        async with db.begin():
+            for start in range(0, len(rows), POSTS_BULK_INSERT_BATCH):
+                result = await db.execute(
+                    insert(Post)
+                    .values(rows[start:start + POSTS_BULK_INSERT_BATCH])
+                    .returning(
+                        Post.id, Post.title, Post.content, Post.price,
+                        Post.user_id, Post.category_id,
+                    )
+                )
+                created.extend(
+                    ShowPost.model_construct(
+                        id=row.id,
+                        title=row.title,
+                        content=row.content,
+                        price=row.price,
+                        user_id=row.user_id,
+                        category_id=row.category_id,
+                    )
+                    for row in result.all()
+                )
+    facet_counts.add(created)
+    return created, errors
+
+
+def _post_detail_query(*extra_columns):
+    """
+    SELECT of exactly the ShowPostDetail columns, authors are joined in
+    the same statement, category names come from the category catalog.
+    """
+    return (
+        select(
+            Post.id,
+            Post.title,
+            Post.content,
+            Post.price,
+            User.email.label('user_email'),
+            Post.category_id,
+            *extra_columns,
+        )
+        .join(User, Post.user_id == User.id)
+    )
+
+
+_POST_BY_ID = _post_detail_query().where(Post.id == bindparam('post_id', type_=Integer))
+# = ANY(array) renders the same SQL for any number of ids
+_POSTS_BY_IDS = _post_detail_query().where(Post.id == any_(bindparam('post_ids', type_=ARRAY(Integer))))
+_POST_SUMMARY_BY_ID = (
+    select(Post.id, Post.user_id, Post.title, Post.price, Post.category_id)
+    .where(Post.id == bindparam('post_id', type_=Integer))
+)
+
+
+async def _rows_to_post_details(rows) -> List[ShowPostDetail]:
+    # rows come typed from the database, so the DTOs skip validation
+    await category_catalog.ensure({row.category_id for row in rows})
+    return [
+        ShowPostDetail.model_construct(
+            id=row.id,
+            title=row.title,
+            content=row.content,
+            price=row.price,
+            user_email=row.user_email,
+            category_name=category_catalog.get(row.category_id).title,
+        )
+        for row in rows
+    ]
+
+
+def _search_condition(search: str):
+    ts_query = func.websearch_to_tsquery(cast(SEARCH_CONFIG, REGCONFIG), search)
+    return Post.search_vector.bool_op('@@')(ts_query), func.ts_rank(Post.search_vector, ts_query)
+
+
+def _keyset_condition(column, sort_desc: bool, value, post_id: int):
+    """
+    Condition selecting the rows that follow (value, post_id) within its
+    section of the sort order, the non-null values or the NULLs, which
+    PostgreSQL puts last when ascending and first when descending.
+    Each section is a single range of the (column, id) index,
+    _next_section_query continues a short page into the following one.
+    """
+    if column is Post.id:
+        return Post.id < post_id if sort_desc else Post.id > post_id
+    if value is None:
+        return and_(column.is_(None), Post.id < post_id if sort_desc else Post.id > post_id)
+    if sort_desc:
+        return tuple_(column, Post.id) < tuple_(value, post_id)
+    return tuple_(column, Post.id) > tuple_(value, post_id)
+
+
+# filters of PostFilter as conditions on bound parameters, same semantics
+# as PostFilter.filter, like patterns without a % are wrapped in them
+_FILTER_CONDITIONS = {
+    'title__ilike': lambda: Post.title.ilike(bindparam('title__ilike', type_=Post.title.type)),
+    'price__gte': lambda: Post.price >= bindparam('price__gte', type_=Post.price.type),
+    'price__lte': lambda: Post.price <= bindparam('price__lte', type_=Post.price.type),
+    'category_id': lambda: Post.category_id == bindparam('category_id', type_=Post.category_id.type),
+    'user_id': lambda: Post.user_id == bindparam('user_id', type_=Post.user_id.type),
+}
+
+# listing statements by (sort_by, sort_desc, filtered fields, keyset kind),
+# a statement built once skips the construction and cache key generation
+# of every call and always renders the same SQL for asyncpg to reuse
+_list_statements: Dict[tuple, Select] = {}
+
+
+def _build_list_statement(sort_by: str, sort_desc: bool, fields: tuple, keyset: Optional[str]) -> Select:
+    sort_column = POST_SORT_COLUMNS[sort_by]
+    query = (
+        _post_detail_query(sort_column.label('sort_key'))
+        .where(*(_FILTER_CONDITIONS[field]() for field in fields))
+        .limit(bindparam('size', type_=Integer))
+    )
+    if keyset is None:
+        query = query.offset(bindparam('offset', type_=Integer))
+    elif keyset == 'not_null':
+        # the non-null values following the NULLs of a descending listing
+        query = query.where(sort_column.is_not(None))
+    else:
+        value = None if keyset == 'null' else bindparam('keyset_value', type_=sort_column.type)
+        post_id = bindparam('keyset_id', type_=Integer)
+        query = query.where(_keyset_condition(sort_column, sort_desc, value, post_id))
+    # sorting, id breaks ties so that the keyset is unique
+    if sort_desc:
+        return query.order_by(desc(sort_column), desc(Post.id))
+    return query.order_by(sort_column, Post.id)
+
+
+def _list_posts_query(
+        size: int,
+        post_filter: PostFilter,
+        page: int = 0,
+        sort_by: str = 'id',
+        sort_desc: bool = False,
+        cursor: Optional[str] = None,
+        search: Optional[str] = None,
+) -> Tuple[Select, dict]:
+    """
+    SELECT of a page of posts and its parameters, see LISTING_INDEXES for
+    the combinations of filters and sorting that are served by an index.
+    """
+    if search:
+        # search terms vary too much to be worth a cached statement
+        sort_column = POST_SORT_COLUMNS[sort_by]
+        condition, rank = _search_condition(search)
+        query = (
+            post_filter.filter(_post_detail_query(sort_column.label('sort_key')))
+            .where(condition)
+            .order_by(desc(rank), desc(sort_column) if sort_desc else sort_column, Post.id)
+            .limit(size)
+            .offset(page*size)
+        )
+        return query, {}
+
+    params = {'size': size}
+    keyset = None
+    if cursor:
+        value, post_id = decode_cursor(cursor, sort_by, sort_desc)
+        keyset = 'null' if value is None else 'value'
+        params['keyset_id'] = post_id
+        if value is not None and sort_by != 'id':
+            params['keyset_value'] = value
+    else:
+        params['offset'] = page*size
+    return _listing_statement(post_filter, sort_by, sort_desc, keyset, params)
+
+
+def _next_section_query(
+        size: int,
+        post_filter: PostFilter,
+        sort_by: str,
+        sort_desc: bool,
+        cursor: str,
+) -> Optional[Tuple[Select, dict]]:
+    """
+    SELECT of the rows following the section of the cursor, the NULLs after
+    the values when ascending and the values after the NULLs when descending.
+    None when the cursor's section is the last one of the sort order.
+    """
+    if sort_by == 'id':
+        return None
+    value, _ = decode_cursor(cursor, sort_by, sort_desc)
+    if not sort_desc and value is not None:
+        # ids are positive, the NULLs are taken from their start
+        return _listing_statement(post_filter, sort_by, sort_desc, 'null', {'size': size, 'keyset_id': 0})
+    if sort_desc and value is None:
+        return _listing_statement(post_filter, sort_by, sort_desc, 'not_null', {'size': size})
+    return None
+
+
+def _listing_statement(
+        post_filter: PostFilter,
+        sort_by: str,
+        sort_desc: bool,
+        keyset: Optional[str],
+        params: dict,
+) -> Tuple[Select, dict]:
+    filters = post_filter.model_dump(exclude_none=True)
+    for field, value in filters.items():
+        if field == 'title__ilike' and '%' not in value:
+            value = f'%{value}%'
+        params[field] = value
+
+    key = (sort_by, sort_desc, tuple(sorted(filters)), keyset)
+    statement = _list_statements.get(key)
+    if statement is None:
+        statement = _list_statements[key] = _build_list_statement(*key)
+    return statement, params
+
+
 async def _get_list_posts(
         db: AsyncSession, 
         page: int, 
         size: int, 
         post_filter: PostFilter = FilterDepends(PostFilter),
         sort_by: str = 'id',
-        sort_desc: bool = False
-) -> List[ShowPostDetail]:
+        sort_desc: bool = False,
+        cursor: Optional[str] = None,
+        search: Optional[str] = None,
+) -> Tuple[List[ShowPostDetail], Optional[str]]:
+    """
+    Returns a page of posts and the cursor for the next page.
+    With a cursor the page is located by keyset instead of offset,
+    so deep pages cost the same as the first one.
+    With a search query posts are matched against the search_vector
+    index and ordered by relevance, paging is then by offset only.
+    """
+    query, params = _list_posts_query(size, post_filter, page, sort_by, sort_desc, cursor, search)
     async with db.begin():
-        query = select(Post).offset(page*size).limit(size).options(
-            selectinload(Post.author),
-            selectinload(Post.category)
-        )
-        
-        # filtration
-        query = post_filter.filter(query)
-
-        # sorting
-        if sort_desc:
-            query = query.order_by(desc(getattr(Post, sort_by)))
-        else:
-            query = query.order_by(getattr(Post, sort_by))
-
-
-        result = await db.execute(query)
-        posts = result.scalars().all()
-        return [
-            ShowPostDetail(
-                id=post.id,
-                title=post.title,
-                content=post.content,
-                price=post.price,
-                user_email=post.author.email,
-                category_name=post.category.title
-            )
-            for post in posts
-        ]
+        result = await db.execute(query, params)
+        rows = result.all()
+        if cursor and not search and len(rows) < size:
+            following = _next_section_query(size - len(rows), post_filter, sort_by, sort_desc, cursor)
+            if following is not None:
+                result = await db.execute(*following)
+                rows += result.all()
+
+    next_cursor = None
+    if rows and len(rows) == size and not search:
+        last = rows[-1]
+        next_cursor = encode_cursor(sort_by, sort_desc, last.sort_key, last.id)
+
+    return await _rows_to_post_details(rows), next_cursor
+
+
+async def _count_posts(
+        db: AsyncSession, post_filter: PostFilter, search: Optional[str], mode: str
+) -> Tuple[int, str]:
+    """
+    Returns the number of filtered posts and whether it is 'exact', 'cached'
+    or 'estimated'. 'exact' runs COUNT(*), 'cached' reuses an exact count
+    for POSTS_COUNT_CACHE_TTL_SECONDS, writes meanwhile are not reflected,
+    'estimated' reads the planner estimate without running the query,
+    'auto' counts exactly only when the estimate is small enough for
+    the count to cost no more than the page.
+    """
+    query = post_filter.filter(select(Post.id))
+    if search:
+        query = query.where(_search_condition(search)[0])
 
+    if mode == 'cached':
+        key = (tuple(sorted(post_filter.model_dump(exclude_none=True).items())), search)
+        total = count_cache.get(key)
+        if total is None:
+            total, _ = await _count_posts(db, post_filter, search, 'exact')
+            count_cache.set(key, total)
+        return total, 'cached'
 
-async def _get_post(post_id: int, db: AsyncSession) -> Post:
     async with db.begin():
-        post = await db.execute(
-            select(Post).where(Post.id == post_id).options(
-                joinedload(Post.author),
-                joinedload(Post.category)
+        if mode in ('estimated', 'auto'):
+            estimate = round(plan_of(await db.execute(Explain(query)))['Plan Rows'])
+            if mode == 'estimated' or estimate > POSTS_EXACT_COUNT_LIMIT:
+                return estimate, 'estimated'
+        result = await db.execute(select(func.count()).select_from(query.subquery()))
+        return result.scalar(), 'exact'
+
+
+async def _get_facets(db: AsyncSession, post_filter: PostFilter) -> PostFacets:
+    """
+    Per-category counts and the price histogram of the filtered posts,
+    both summed up from one query grouped by category and price bucket.
+    Without filters they come from facet_counts instead.
+    """
+    if post_filter.model_dump(exclude_none=True):
+        async with db.begin():
+            result = await db.execute(post_filter.filter(_facets_query()))
+            items = [((row.category_id, row.bucket), row.count) for row in result.all()]
+    else:
+        items = await facet_counts.current()
+
+    categories, buckets = Counter(), Counter()
+    for (category_id, bucket), count in items:
+        categories[category_id] += count
+        if bucket is not None:
+            buckets[bucket] += count
+    await category_catalog.ensure(categories)
+    bounds = POSTS_FACET_PRICE_BOUNDS
+    return PostFacets(
+        total=sum(categories.values()),
+        categories=[
+            CategoryFacet(
+                category_id=category_id,
+                category_name=category_catalog.get(category_id).title,
+                count=count,
             )
-        )
-        return post.scalars().first()
+            for category_id, count in sorted(categories.items())
+        ],
+        prices=[
+            PriceBucket(
+                price_from=bounds[bucket - 1],
+                price_to=bounds[bucket] if bucket < len(bounds) else None,
+                count=buckets[bucket],
+            )
+            for bucket in range(1, len(bounds) + 1)
+        ],
+    )
+
+
+async def _stream_posts(
+        post_filter: PostFilter, batch_size: int = 1000
+) -> AsyncIterator[List[ShowPostDetail]]:
+    """
+    Yields all filtered posts in batches read from a server-side cursor,
+    so memory does not grow with the number of rows.
+    The stream outlives the request scope, so it uses its own session.
+    asyncpg cursors need a transaction, REPEATABLE READ also makes the
+    whole export one consistent snapshot.
+    """
+    async with async_session() as db:
+        async with db.begin():
+            query = post_filter.filter(_post_detail_query()).order_by(Post.id)
+            # the connection must be the one the query is routed to
+            await db.connection(
+                bind_arguments={'clause': query},
+                execution_options={'isolation_level': 'REPEATABLE READ'},
+            )
+            result = await db.stream(query.execution_options(yield_per=batch_size))
+            async for rows in result.partitions():
+                yield await _rows_to_post_details(rows)
+
+
+async def _get_post(post_id: int, db: AsyncSession) -> Optional[ShowPostDetail]:
+    async with db.begin():
+        result = await db.execute(_POST_BY_ID, {'post_id': post_id})
+        row = result.first()
+    if row is not None:
+        return (await _rows_to_post_details([row]))[0]
+
+
+async def _get_posts_by_ids(
+        post_ids: List[int], db: AsyncSession
+) -> Tuple[List[ShowPostDetail], List[int]]:
+    """
+    Returns the posts in the order of the ids, duplicates once, in one
+    query, and the ids of the posts that do not exist.
+    """
+    post_ids = list(dict.fromkeys(post_ids))
+    async with db.begin():
+        result = await db.execute(_POSTS_BY_IDS, {'post_ids': post_ids})
+        rows = {row.id: row for row in result.all()}
+    posts = await _rows_to_post_details([rows[post_id] for post_id in post_ids if post_id in rows])
+    return posts, [post_id for post_id in post_ids if post_id not in rows]
+
+
+async def _get_post_summary(post_id: int, db: AsyncSession):
+    """
+    Returns the post's author and the fields its listings are filtered by.
+    """
+    async with db.begin():
+        result = await db.execute(_POST_SUMMARY_BY_ID, {'post_id': post_id})
+        return result.first()
         
     
-async def _delete_post(post_id: int, db: AsyncSession) -> int:
-    exists_statement = delete(Post).where(
-        (Post.id == post_id)
-    )
-    await db.execute(exists_statement)
-    await db.commit()
+_DELETED_POST_COLUMNS = (Post.id, Post.user_id, Post.title, Post.price, Post.category_id)
+
 
-    return post_id
\ No newline at end of file
+async def _delete_post(post_id: int, db: AsyncSession, current_user: User):
+    """
+    Deletes the post in one statement if the user is its author or an admin.
+    Returns the deleted post's summary, None when nothing was deleted.
+    """
+    condition = Post.id == post_id
+    if not current_user.is_admin:
+        condition = and_(condition, Post.user_id == current_user.id)
+    async with db.begin():
+        result = await db.execute(
+            delete(Post).where(condition).returning(*_DELETED_POST_COLUMNS)
+            .execution_options(synchronize_session=False)
+        )
+        post = result.first()
+    if post is not None:
+        facet_counts.remove([post])
+    return post
+
+
+async def _delete_posts_in_batches(
+        db: AsyncSession,
+        ids: Optional[List[int]] = None,
+        user_id: Optional[UUID] = None,
+        category_id: Optional[int] = None,
+        batch_size: int = 1000,
+        max_batches: Optional[int] = None,
+        on_batch: Optional[Callable[[list], None]] = None,
+) -> Tuple[int, bool]:
+    """
+    Deletes the matching posts batch by batch, each batch in its own short
+    transaction, so a large sweep never holds many row locks for long.
+    on_batch gets the summaries of each committed batch, only their number
+    is kept. Stops after max_batches, returns the number of deleted posts
+    and whether matching posts may remain.
+    """
+    conditions = []
+    if ids is not None:
+        conditions.append(Post.id.in_(ids))
+    if user_id is not None:
+        conditions.append(Post.user_id == user_id)
+    if category_id is not None:
+        conditions.append(Post.category_id == category_id)
+    batch = select(Post.id).where(*conditions).limit(batch_size).scalar_subquery()
+
+    deleted = 0
+    batches = 0
+    while True:
+        async with db.begin():
+            result = await db.execute(
+                delete(Post).where(Post.id.in_(batch)).returning(*_DELETED_POST_COLUMNS)
+                .execution_options(synchronize_session=False)
+            )
+            rows = result.all()
+        facet_counts.remove(rows)
+        if on_batch is not None:
+            on_batch(rows)
+        deleted += len(rows)
+        batches += 1
+        if len(rows) < batch_size:
+            return deleted, False
+        if max_batches is not None and batches >= max_batches:
+            return deleted, True
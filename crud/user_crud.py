@@ -1,7 +1,13 @@
-from typing import Optional
+import asyncio
+import hashlib
+import secrets
+import time
+from logging import getLogger
+from typing import List, Optional, Tuple
 from datetime import datetime, timedelta
-from uuid import UUID
+from uuid import UUID, uuid4
 
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
@@ -12,26 +18,30 @@ from envparse import Env
 
 from database.models import Role
 from database.schemas import UserCreate, ShowUser
-from database.dals import UserDAL
-from database.db import get_db
-from utils import Hasher
+from database.dals import RefreshTokenDAL, UserDAL
+from database.db import async_session, get_db, replica_router
+from database.notify import broadcast
+from utils import Hasher, TTLCache
 """
 Block for working with the user model, 
 registration and authorization.
 """
 env = Env()
+logger = getLogger(__name__)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='/user/token')
 
 
 async def _create_new_user(body: UserCreate, db: AsyncSession) -> ShowUser:
+    # hash before opening the transaction so that no connection is held meanwhile
+    hashed_password = await Hasher.get_password_hash_async(body.password)
     async with db.begin():
         user_dal = UserDAL(db)
         user = await user_dal.create_user(
             name=body.name,
             surname=body.surname,
             email=body.email,
-            hashed_password=Hasher.get_password_hash(body.password),
+            hashed_password=hashed_password,
             roles=[
                 Role.ROLE_USER,
             ],
@@ -58,10 +68,12 @@ async def _get_user_by_email_for_auth(
 async def authenticate_user(
         email: str, password: str, db: AsyncSession
 ):
+    # a user who has just signed up may not have reached the replicas yet
+    db.info['use_primary'] = True
     user = await _get_user_by_email_for_auth(email=email, db=db)
     if user is None:
         return
-    if not Hasher.verify_password(password, user.hashed_password):
+    if not await Hasher.verify_password_async(password, user.hashed_password):
         return
     return user
 
@@ -70,6 +82,46 @@ async def authenticate_user(
 SECRET_KEY = env.str('SECRET_KEY', default='secret_key')
 ALGORITHM = env.str('ALGORITHM', default='HS256')
 ACCESS_TOKEN_EXPIRE_MINUTES = env.int('ACCESS_TOKEN_EXPIRE_MINUTES', default=30)
+REFRESH_TOKEN_EXPIRE_DAYS = env.int('REFRESH_TOKEN_EXPIRE_DAYS', default=30)
+# how often expired refresh tokens are deleted, and how many per statement
+REFRESH_TOKEN_PRUNE_SECONDS = env.float('REFRESH_TOKEN_PRUNE_SECONDS', default=3600.0)
+REFRESH_TOKEN_PRUNE_BATCH_SIZE = env.int('REFRESH_TOKEN_PRUNE_BATCH_SIZE', default=1000)
+
+# variables to configure the cache of authenticated users
+AUTH_CACHE_SIZE = env.int('AUTH_CACHE_SIZE', default=1024)
+# bounds how long another process may see an old role when invalidations
+# are not broadcast (BROADCAST_INVALIDATIONS) or their channel is down
+AUTH_CACHE_TTL_SECONDS = env.float('AUTH_CACHE_TTL_SECONDS', default=60.0)
+
+# verified token claims, keyed by the raw token
+token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+# detached users, keyed by email
+user_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+
+
+def _drop_cached_user(user_id: Optional[str]) -> None:
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_id = UUID(user_id)
+        user_cache.pop_if(lambda user: user.id == user_id)
+
+
+def invalidate_cached_user(user_id: UUID) -> None:
+    """Drops the cached user in this process and in the others."""
+    _drop_cached_user(str(user_id))
+    broadcast.publish('user', str(user_id))
+
+
+broadcast.subscribe('user', _drop_cached_user)
+broadcast.on_reset(user_cache.clear)
+
+
+def get_auth_cache_stats() -> dict:
+    return {
+        'tokens': token_cache.stats(),
+        'users': user_cache.stats(),
+    }
 
 
 async def get_current_user_from_token(
@@ -79,20 +131,38 @@ async def get_current_user_from_token(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
     )
-    try:
-        payload = jwt.decode(
-            token, 
-            SECRET_KEY,
-            algorithms = [ALGORITHM],
-        )
-        email: str = payload.get('sub')
-        if email is None:
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(
+                token, 
+                SECRET_KEY,
+                algorithms = [ALGORITHM],
+            )
+        except JWTError:
             raise credentials_exception
-    except JWTError:
+        # a cached token must not outlive its own expiration
+        expire = payload.get('exp')
+        token_cache.set(token, payload, None if expire is None else expire - time.time())
+    email: str = payload.get('sub')
+    if email is None:
         raise credentials_exception
-    user = await _get_user_by_email_for_auth(email=email, db=db)
+    user = user_cache.get(email)
     if user is None:
-        raise credentials_exception
+        user = await _get_user_by_email_for_auth(email=email, db=db)
+        if user is not None and replica_router.is_pinned(user.id):
+            # the user was changed moments ago, the replica may be behind
+            db.expunge(user)
+            db.info['use_primary'] = True
+            user = await _get_user_by_email_for_auth(email=email, db=db)
+        if user is None:
+            raise credentials_exception
+        # the cached instance is shared between requests, so it must not
+        # belong to the session of this one
+        db.expunge(user)
+        user_cache.set(email, user)
+    # routes reads of a user who has just written to the primary
+    db.info['user_id'] = user.id
     return user
 
 
@@ -111,22 +181,106 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def _get_user_by_id(user_id, db: AsyncSession):
+def _hash_refresh_token(refresh_token: str) -> str:
+    # the token is 256 random bits, a fast hash is enough to store it
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+async def create_refresh_token(user_id: UUID, db: AsyncSession) -> str:
+    """Issues a refresh token that starts a new family."""
+    refresh_token = secrets.token_urlsafe(32)
     async with db.begin():
-        user_dal = UserDAL(db)
-        user = await user_dal.get_user_by_id(
+        await RefreshTokenDAL(db).create_token(
             user_id=user_id,
+            family_id=uuid4(),
+            token_hash=_hash_refresh_token(refresh_token),
+            expires_in=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
         )
-        if user is not None:
-            return user
-        
+    return refresh_token
 
-async def _update_user(
-    updated_user_params: dict, user_id: UUID, db: AsyncSession
-):
+
+async def _rotate_refresh_token(
+    refresh_token: str, db: AsyncSession
+) -> Optional[Tuple[str, str]]:
+    """
+    Exchanges a refresh token for a new one of the same family.
+    Returns the user's email and the new token, None if the token is not
+    valid. A token presented again after it was used is taken as stolen
+    and revokes its whole family.
+    """
+    token_hash = _hash_refresh_token(refresh_token)
+    new_refresh_token = secrets.token_urlsafe(32)
     async with db.begin():
-        user_dal = UserDAL(db)
-        updated_user_id = await user_dal.update_user(
-            user_id=user_id, **updated_user_params
+        token_dal = RefreshTokenDAL(db)
+        used = await token_dal.use_token(token_hash)
+        if used is None:
+            family_id = await token_dal.get_family_id(token_hash, revoked=True)
+            if family_id is not None:
+                await token_dal.revoke_family(family_id)
+            return None
+        await token_dal.create_token(
+            user_id=used.user_id,
+            family_id=used.family_id,
+            token_hash=_hash_refresh_token(new_refresh_token),
+            expires_in=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
         )
-        return updated_user_id
\ No newline at end of file
+    return used.email, new_refresh_token
+
+
+async def _revoke_refresh_token(refresh_token: str, db: AsyncSession) -> None:
+    """Revokes the token and every token issued from the same login."""
+    async with db.begin():
+        token_dal = RefreshTokenDAL(db)
+        family_id = await token_dal.get_family_id(_hash_refresh_token(refresh_token))
+        if family_id is not None:
+            await token_dal.revoke_family(family_id)
+
+
+async def prune_refresh_tokens() -> int:
+    """
+    Deletes the expired refresh tokens batch by batch, each batch in its
+    own short transaction. Returns how many were deleted.
+    """
+    pruned = 0
+    async with async_session() as db:
+        token_dal = RefreshTokenDAL(db)
+        while True:
+            async with db.begin():
+                deleted = await token_dal.delete_expired(REFRESH_TOKEN_PRUNE_BATCH_SIZE)
+            pruned += deleted
+            if deleted < REFRESH_TOKEN_PRUNE_BATCH_SIZE:
+                return pruned
+
+
+async def run_refresh_token_pruning() -> None:
+    """Lifespan task, every rotation leaves a row behind until it expires."""
+    while True:
+        try:
+            await prune_refresh_tokens()
+        except (SQLAlchemyError, OSError) as err:
+            logger.warning('Expired refresh tokens were not pruned: %s', err)
+        await asyncio.sleep(REFRESH_TOKEN_PRUNE_SECONDS)
+
+
+async def _change_admin_role(
+    user_ids: List[UUID], grant: bool, db: AsyncSession
+) -> Tuple[List[UUID], List[UUID], List[UUID], List[UUID]]:
+    """
+    Grants or revokes the admin role of the users in one statement.
+    Returns the ids that were changed, skipped (role already as requested),
+    not found and inactive.
+    """
+    # the UPDATE runs inside a SELECT, so it has to be routed by hand
+    db.info['use_primary'] = True
+    async with db.begin():
+        user_dal = UserDAL(db)
+        rows = await user_dal.change_role(user_ids, Role.ROLE_ADMIN, grant)
+    changed = [row.id for row in rows if row.changed]
+    found = {row.id for row in rows}
+    skipped = [row.id for row in rows if row.is_active and not row.changed]
+    inactive = [row.id for row in rows if not row.is_active]
+    not_found = [user_id for user_id in user_ids if user_id not in found]
+    for user_id in changed:
+        invalidate_cached_user(user_id)
+        replica_router.pin(user_id)
+    return changed, skipped, not_found, inactive
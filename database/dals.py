@@ -1,11 +1,20 @@
 from uuid import UUID
 
-from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
 from sqlalchemy import select
 from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import Role, User
+from database.models import RefreshToken, Role, User
+
+
+# hot lookups are built once and executed with parameters
+_USER_BY_EMAIL = select(User).where(User.email == bindparam('email', type_=User.email.type))
+_USER_BY_ID = select(User).where(User.id == bindparam('user_id', type_=User.id.type))
+
 
 class UserDAL:
     """Data Access Layer for operating user info"""
@@ -34,31 +43,117 @@ class UserDAL:
     
 
     async def get_user_by_email(self, email: str):
-        query = select(User).where(User.email == email)
-        res = await self.db_session.execute(query)
+        res = await self.db_session.execute(_USER_BY_EMAIL, {'email': email})
         user_row = res.fetchone()
         if user_row is not None:
             return user_row[0]
         
     
     async def get_user_by_id(self, user_id: UUID):
-        query = select(User).where(User.id == user_id)
-        res = await self.db_session.execute(query)
+        res = await self.db_session.execute(_USER_BY_ID, {'user_id': user_id})
         user_row = res.fetchone()
         if user_row is not None:
             return user_row[0]
         
 
-    async def update_user(self, user_id: UUID, **kwargs):
-        query = (
+    async def change_role(self, user_ids: list[UUID], role: Role, grant: bool):
+        """
+        Adds or removes the role of the active users in one atomic UPDATE.
+        Returns (id, is_active, changed) for each id that exists.
+        """
+        if grant:
+            roles = func.array_append(User.roles, role.value)
+            condition = ~User.roles.any(role.value)
+        else:
+            roles = func.array_remove(User.roles, role.value)
+            condition = User.roles.any(role.value)
+        target = select(User.id, User.is_active).where(User.id.in_(user_ids)).cte('target')
+        updated = (
             update(User)
-            .where(and_(User.id == user_id, User.is_active == True))
-            .values(kwargs)
+            .where(User.id.in_(select(target.c.id)), User.is_active == True, condition)
+            .values(roles=roles)
             .returning(User.id)
+            .cte('updated')
         )
+        query = select(
+            target.c.id, target.c.is_active, updated.c.id.is_not(None).label('changed')
+        ).outerjoin(updated, updated.c.id == target.c.id)
         res = await self.db_session.execute(query)
-        update_user_id_row = res.fetchone()
-        if update_user_id_row is not None:
-            return update_user_id_row[0]
-        
-    
\ No newline at end of file
+        return res.all()
+
+
+class RefreshTokenDAL:
+    """Data Access Layer for operating refresh tokens"""
+
+    def __init__(self, db_session: AsyncSession):
+        self.db_session = db_session
+
+    async def create_token(self, user_id: UUID, family_id: UUID, token_hash: str, expires_in) -> None:
+        await self.db_session.execute(
+            insert(RefreshToken).values(
+                user_id=user_id,
+                family_id=family_id,
+                token_hash=token_hash,
+                expires_at=func.now() + expires_in,
+            )
+        )
+
+
+    async def use_token(self, token_hash: str):
+        """
+        Revokes the token if it is valid and its user is active, in one
+        statement, so that a token is used at most once.
+        Returns (user_id, family_id, email) of the used token.
+        """
+        # tables rather than entities, so that RETURNING keeps users.email
+        tokens, users = RefreshToken.__table__, User.__table__
+        query = (
+            update(tokens)
+            .where(
+                tokens.c.token_hash == token_hash,
+                tokens.c.revoked_at.is_(None),
+                tokens.c.expires_at > func.now(),
+                tokens.c.user_id == users.c.id,
+                users.c.is_active == True,
+            )
+            .values(revoked_at=func.now())
+            .returning(tokens.c.user_id, tokens.c.family_id, users.c.email)
+        )
+        res = await self.db_session.execute(query)
+        return res.first()
+
+
+    async def get_family_id(self, token_hash: str, revoked: bool = False):
+        query = select(RefreshToken.family_id).where(RefreshToken.token_hash == token_hash)
+        if revoked:
+            query = query.where(RefreshToken.revoked_at.is_not(None))
+        res = await self.db_session.execute(query)
+        return res.scalar()
+
+
+    async def revoke_family(self, family_id: UUID) -> None:
+        await self.db_session.execute(
+            update(RefreshToken)
+            .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+            .values(revoked_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+
+
+    async def delete_expired(self, limit: int) -> int:
+        """
+        Deletes up to limit expired tokens, revoked ones included, they are
+        no longer needed to detect reuse. Rows locked by another sweep are
+        skipped. Returns how many were deleted.
+        """
+        expired = (
+            select(RefreshToken.id)
+            .where(RefreshToken.expires_at < func.now())
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        res = await self.db_session.execute(
+            delete(RefreshToken).where(RefreshToken.id.in_(expired))
+            .execution_options(synchronize_session=False)
+        )
+        return res.rowcount
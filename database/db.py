@@ -1,30 +1,224 @@
-from sqlalchemy import create_engine
-from typing import Generator
+import asyncio
+import itertools
+import time
+from logging import getLogger
+from sqlalchemy import create_engine, text
+from typing import Generator, List, Optional
+from uuid import UUID
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.dml import UpdateBase
 from envparse import Env
 
+from .notify import broadcast
+
 """
 Block for common interaction with database
 """
 env = Env()
+logger = getLogger(__name__)
 
 REAL_DATABASE_URL = env.str(
     "REAL_DATABASE_URL",
     default="postgresql+asyncpg://postgres:postgres@db:5432/postgres",
 )
 
-engine = create_async_engine(
-    REAL_DATABASE_URL,
-    future=True,
-    echo=True,
-    execution_options={"isolation_level": "AUTOCOMMIT"},
-)
+# variables to configure the connection pool
+DB_ECHO = env.bool("DB_ECHO", default=False)
+DB_POOL_SIZE = env.int("DB_POOL_SIZE", default=5)
+DB_MAX_OVERFLOW = env.int("DB_MAX_OVERFLOW", default=10)
+DB_POOL_TIMEOUT = env.float("DB_POOL_TIMEOUT", default=30.0)
+DB_POOL_RECYCLE = env.int("DB_POOL_RECYCLE", default=1800)
+DB_POOL_PRE_PING = env.bool("DB_POOL_PRE_PING", default=True)
+# connections opened at startup, at most DB_POOL_SIZE are kept
+DB_POOL_WARMUP = env.int("DB_POOL_WARMUP", default=2)
+DB_PREPARED_STATEMENT_CACHE_SIZE = env.int("DB_PREPARED_STATEMENT_CACHE_SIZE", default=100)
+# worker processes of the server, each of them has its own pool
+WEB_CONCURRENCY = env.int("WEB_CONCURRENCY", default=1)
+# connections all workers together may open to one database, i.e. the
+# server's max_connections minus superuser_reserved_connections and
+# other clients, 0 for no limit
+DB_MAX_CONNECTIONS = env.int("DB_MAX_CONNECTIONS", default=0)
+# fan out cache invalidations and replica pins to the other processes
+# (database/notify.py), needed whenever more than one process serves the app
+BROADCAST_INVALIDATIONS = env.bool("BROADCAST_INVALIDATIONS", default=WEB_CONCURRENCY > 1)
+
+
+def _size_pool(pool_size: int, max_overflow: int):
+    """Shrinks the pool of a worker to its share of DB_MAX_CONNECTIONS."""
+    if not DB_MAX_CONNECTIONS:
+        return pool_size, max_overflow
+    share = DB_MAX_CONNECTIONS // max(WEB_CONCURRENCY, 1)
+    if BROADCAST_INVALIDATIONS:
+        # the LISTEN connection of the worker is not pooled
+        share -= 1
+    if share < 1:
+        raise RuntimeError(
+            f"DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS} is less than one pooled connection "
+            f"per worker for WEB_CONCURRENCY={WEB_CONCURRENCY}"
+        )
+    pool_size = min(pool_size, share)
+    return pool_size, min(max_overflow, share - pool_size)
+
+
+DB_POOL_SIZE, DB_MAX_OVERFLOW = _size_pool(DB_POOL_SIZE, DB_MAX_OVERFLOW)
+
+# variables to configure read replicas, urls are comma separated
+REPLICA_DATABASE_URLS = [
+    url.strip() for url in env.str("REPLICA_DATABASE_URLS", default="").split(",") if url.strip()
+]
+REPLICA_HEALTH_INTERVAL = env.float("REPLICA_HEALTH_INTERVAL", default=5.0)
+# how long reads of a user who wrote go to the primary, covers replication lag
+REPLICA_STICKY_SECONDS = env.float("REPLICA_STICKY_SECONDS", default=5.0)
+
+
+class PoolStats:
+    """
+    How long checkouts waited for a connection from the pool.
+    """
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, wait_seconds: float) -> None:
+        self.checkouts += 1
+        self.wait_seconds_total += wait_seconds
+        if wait_seconds > self.wait_seconds_max:
+            self.wait_seconds_max = wait_seconds
+
+
+pool_stats = PoolStats()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records the checkout wait time."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_stats.record(time.perf_counter() - started)
+
+
+def _create_engine(url: str, poolclass=AsyncAdaptedQueuePool) -> AsyncEngine:
+    return create_async_engine(
+        url,
+        future=True,
+        echo=DB_ECHO,
+        execution_options={"isolation_level": "AUTOCOMMIT"},
+        poolclass=poolclass,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={"prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE},
+    )
+
+
+engine = _create_engine(REAL_DATABASE_URL, poolclass=TimedQueuePool)
+
+
+class ReplicaRouter:
+    """
+    Round-robin over the replicas that passed the last health check.
+    """
+    def __init__(self, engines: List[AsyncEngine]):
+        self.engines = engines
+        self.healthy = list(engines)
+        self._counter = itertools.count()
+        # user id -> until when the user's reads go to the primary
+        self._pins = {}
+
+    def pick(self) -> Optional[AsyncEngine]:
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def pin(self, user_id) -> None:
+        if user_id is None or not self.engines:
+            return
+        # the other processes are told too, again once half of the pin has passed
+        if self._pins.get(user_id, 0) - time.monotonic() < REPLICA_STICKY_SECONDS / 2:
+            broadcast.publish('pin', str(user_id))
+        self._pin(user_id)
+
+    def _pin(self, user_id) -> None:
+        if not self.engines:
+            return
+        now = time.monotonic()
+        if len(self._pins) > 10000:
+            self._pins = {key: until for key, until in self._pins.items() if until > now}
+        self._pins[user_id] = now + REPLICA_STICKY_SECONDS
+
+    def is_pinned(self, user_id) -> bool:
+        return self._pins.get(user_id, 0) > time.monotonic()
+
+    @staticmethod
+    async def _probe(replica: AsyncEngine) -> None:
+        async with replica.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    async def _is_healthy(self, replica: AsyncEngine) -> bool:
+        # the timeout covers the connect, an unreachable host would block it for a minute
+        try:
+            await asyncio.wait_for(self._probe(replica), REPLICA_HEALTH_INTERVAL)
+            return True
+        except (SQLAlchemyError, OSError, asyncio.TimeoutError) as err:
+            logger.warning('Replica %s is unavailable: %s', replica.url.host, str(err) or type(err).__name__)
+            return False
+
+    async def check(self) -> None:
+        """Probes all replicas at once, a slow one does not delay the others."""
+        results = await asyncio.gather(*(self._is_healthy(replica) for replica in self.engines))
+        self.healthy = [replica for replica, healthy in zip(self.engines, results) if healthy]
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+
+
+replica_router = ReplicaRouter([_create_engine(url) for url in REPLICA_DATABASE_URLS])
+broadcast.subscribe('pin', lambda user_id: replica_router._pin(UUID(user_id)))
+
+
+class RoutingSession(Session):
+    """
+    Sends SELECTs to a replica and everything else to the primary.
+    A session keeps the replica it picked, and once it writes, or its user
+    wrote recently (info['user_id']), it reads from the primary too.
+    info['use_primary'] forces the primary.
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['use_primary'] = True
+            replica_router.pin(self.info.get('user_id'))
+        elif (
+            isinstance(clause, Select)
+            and replica_router.healthy
+            and not self.info.get('use_primary')
+            and not replica_router.is_pinned(self.info.get('user_id'))
+        ):
+            replica = self.info.get('replica')
+            if replica is None:
+                replica = self.info['replica'] = replica_router.pick()
+            return replica.sync_engine
+        return engine.sync_engine
+
 
 # create session for the interaction with database
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+async_session = sessionmaker(
+    engine, expire_on_commit=False, class_=AsyncSession, sync_session_class=RoutingSession,
+)
 
 
 async def get_db() -> Generator:
@@ -36,4 +230,39 @@ async def get_db() -> Generator:
         await session.close()
 
 
-Base = declarative_base()
\ No newline at end of file
+async def warm_up_pool(connections: int = DB_POOL_WARMUP) -> None:
+    """Open connections ahead of the first requests, they stay in the pool."""
+    connections = min(connections, DB_POOL_SIZE)
+    if connections <= 0:
+        return
+    opened = await asyncio.gather(
+        *(engine.connect() for _ in range(connections)), return_exceptions=True
+    )
+    for connection in opened:
+        if isinstance(connection, BaseException):
+            logger.warning('Database connection was not warmed up: %s', connection)
+        else:
+            await connection.close()
+
+
+async def dispose_engine() -> None:
+    """Close the pooled connections on shutdown."""
+    await engine.dispose()
+    for replica in replica_router.engines:
+        await replica.dispose()
+
+
+def get_pool_stats() -> dict:
+    pool = engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'checkouts': pool_stats.checkouts,
+        'wait_seconds_total': pool_stats.wait_seconds_total,
+        'wait_seconds_max': pool_stats.wait_seconds_max,
+    }
+
+
+Base = declarative_base()
@@ -3,25 +3,32 @@ from enum import Enum
 from sqlalchemy import (
     Boolean,
     Column,
+    Computed,
+    DateTime,
     String,
     Integer,
+    Index,
     Text,
     Numeric,
     ForeignKey,
+    func,
     )
 from sqlalchemy.dialects.postgresql import (
     ARRAY,
+    TSVECTOR,
     UUID
     )
 from sqlalchemy.orm import relationship
 
 from .db import Base
-from .schemas import ShowPostDetail
 
 """
 Block with database models.
 """
 
+# text search configuration of posts.search_vector
+SEARCH_CONFIG = 'simple'
+
 class Role(str, Enum):
     """
     We describe user roles in the system
@@ -53,16 +60,6 @@ class User(Base):
     @property
     def is_admin(self):
         return Role.ROLE_ADMIN in self.roles
-    
-
-    def adding_admin_role(self):
-        if not self.is_admin:
-            return {*self.roles, Role.ROLE_ADMIN}
-        
-    
-    def remove_admin_role(self):
-        if self.is_admin:
-            return {role for role in self.roles if role != Role.ROLE_ADMIN}
 
 
 class Post(Base):
@@ -87,19 +84,35 @@ class Post(Base):
         nullable=False,
     )
 
+    # maintained by PostgreSQL from title and content
+    search_vector = Column(
+        TSVECTOR,
+        Computed(
+            f"to_tsvector('{SEARCH_CONFIG}'::regconfig, "
+            "coalesce(title, '') || ' ' || coalesce(content, ''))",
+            persisted=True,
+        ),
+    )
+
     author = relationship('User', back_populates='posts')
     category = relationship('Category', back_populates='posts')
 
-
-    def as_show_model(self) -> ShowPostDetail:
-        return ShowPostDetail(
-            id=self.id,
-            title=self.title,
-            content=self.content,
-            price=self.price,
-            user_email=self.author.email,
-            category_name=self.category.title
-        )
+    __table_args__ = (
+        # one per sorting of the listings, with and without the category filter
+        Index('ix_posts_price_id', 'price', 'id'),
+        Index('ix_posts_title_id', 'title', 'id'),
+        Index('ix_posts_category_id_id', 'category_id', 'id'),
+        Index('ix_posts_category_id_price_id', 'category_id', 'price', 'id'),
+        Index('ix_posts_category_id_title_id', 'category_id', 'title', 'id'),
+        # listings of an author, also serves the cascade from users
+        Index('ix_posts_user_id_id', 'user_id', 'id'),
+        Index('ix_posts_search_vector', 'search_vector', postgresql_using='gin'),
+        Index(
+            'ix_posts_title_trgm', 'title',
+            postgresql_using='gin',
+            postgresql_ops={'title': 'gin_trgm_ops'},
+        ),
+    )
 
 
 class Category(Base):
@@ -113,4 +126,25 @@ class Category(Base):
     title = Column(String(32))
     description = Column(Text)
 
-    posts= relationship('Post', back_populates='category')
\ No newline at end of file
+    posts= relationship('Post', back_populates='category')
+
+
+class RefreshToken(Base):
+    """
+    Define the refresh token model. Only the SHA-256 of a token is stored,
+    the tokens issued one from another share the family.
+    """
+    __tablename__ = 'refresh_tokens'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+    family_id = Column(UUID(as_uuid=True), nullable=False, index=True)
+    token_hash = Column(String(64), nullable=False, unique=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    revoked_at = Column(DateTime(timezone=True), nullable=True)
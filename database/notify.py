@@ -0,0 +1,162 @@
+import asyncio
+import json
+from contextlib import suppress
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import asyncpg
+from envparse import Env
+
+"""
+Block for fanning out cache invalidations between the processes of the app
+with PostgreSQL LISTEN/NOTIFY.
+"""
+env = Env()
+logger = getLogger(__name__)
+
+# all processes sharing a database must use the same channel
+BROADCAST_CHANNEL = env.str("BROADCAST_CHANNEL", default="board_invalidation")
+# seconds between pings of an idle connection and between reconnect attempts
+BROADCAST_PING_SECONDS = env.float("BROADCAST_PING_SECONDS", default=5.0)
+# messages kept while the connection is down, beyond that the others are reset
+BROADCAST_MAX_PENDING = env.int("BROADCAST_MAX_PENDING", default=10000)
+
+# NOTIFY payloads must be shorter than 8000 bytes, json.dumps keeps them ASCII
+_MAX_PAYLOAD = 7800
+RESET = "reset"
+
+_ERRORS = (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError)
+
+
+class Broadcast:
+    """
+    Invalidation messages between the processes sharing a database.
+    publish() queues a message for a background task that sends it with
+    pg_notify on its own connection. The same connection LISTENs and hands
+    the messages of the other processes to the handler of their kind.
+    A handler gets None when the message was too large to send, it should
+    then drop everything of its kind. Whenever messages may have been lost,
+    after a reconnect or when too many were pending, caches are reset
+    through the on_reset handlers.
+    """
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.origin = uuid4().hex
+        self._handlers: Dict[str, Callable[[Any], None]] = {}
+        self._reset_handlers: List[Callable[[], None]] = []
+        self._pending: List[list] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, kind: str, handler: Callable[[Any], None]) -> None:
+        self._handlers[kind] = handler
+
+    def on_reset(self, handler: Callable[[], None]) -> None:
+        self._reset_handlers.append(handler)
+
+    def publish(self, kind: str, data: Any) -> None:
+        """Queues a message for the other processes, a no-op until started."""
+        if self._task is None:
+            return
+        if len(self._pending) >= BROADCAST_MAX_PENDING:
+            # the others cannot tell what they missed, so they drop everything
+            self._pending = [[RESET, None]]
+        self._pending.append([kind, data])
+        self._wakeup.set()
+
+    def start(self, dsn: str) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(dsn))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _run(self, dsn: str) -> None:
+        listened = False
+        while True:
+            try:
+                connection = await asyncpg.connect(dsn, timeout=BROADCAST_PING_SECONDS)
+            except _ERRORS as err:
+                logger.warning('Invalidation channel is unavailable: %s', err)
+                await asyncio.sleep(BROADCAST_PING_SECONDS)
+                continue
+            try:
+                await connection.add_listener(self.channel, self._receive)
+                if listened:
+                    # messages of the others may have been missed meanwhile
+                    self._reset()
+                listened = True
+                await self._send_pending(connection)
+            except _ERRORS as err:
+                logger.warning('Invalidation channel was interrupted: %s', err)
+            finally:
+                connection.terminate()
+
+    async def _send_pending(self, connection) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), BROADCAST_PING_SECONDS)
+                except asyncio.TimeoutError:
+                    # notices a broken connection while there is nothing to send
+                    await connection.execute('SELECT 1', timeout=BROADCAST_PING_SECONDS)
+                continue
+            payload, batch = self._take_batch()
+            try:
+                await connection.execute(
+                    'SELECT pg_notify($1, $2)', self.channel, payload, timeout=BROADCAST_PING_SECONDS,
+                )
+            except BaseException:
+                # sent again after the reconnect, invalidations are idempotent
+                self._pending[:0] = batch
+                raise
+
+    def _take_batch(self) -> Tuple[str, List[list]]:
+        """Takes as many pending messages as fit into one NOTIFY payload."""
+        encoded, size = [], 0
+        for kind, data in self._pending:
+            message = json.dumps([kind, data], separators=(',', ':'))
+            if len(message) > _MAX_PAYLOAD:
+                message = json.dumps([kind, None])
+            if encoded and size + len(message) > _MAX_PAYLOAD:
+                break
+            encoded.append(message)
+            size += len(message) + 1
+        batch = self._pending[:len(encoded)]
+        del self._pending[:len(encoded)]
+        payload = '{"origin":%s,"messages":[%s]}' % (json.dumps(self.origin), ','.join(encoded))
+        return payload, batch
+
+    def _receive(self, connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning('Malformed invalidation message: %r', payload[:200])
+            return
+        if message.get('origin') == self.origin:
+            return
+        for kind, data in message.get('messages', ()):
+            if kind == RESET:
+                self._reset()
+                continue
+            handler = self._handlers.get(kind)
+            if handler is None:
+                continue
+            try:
+                handler(data)
+            except Exception:
+                logger.exception('Invalidation %s failed', kind)
+
+    def _reset(self) -> None:
+        for handler in self._reset_handlers:
+            handler()
+
+
+broadcast = Broadcast(BROADCAST_CHANNEL)
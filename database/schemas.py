@@ -1,7 +1,7 @@
 import re
 import uuid
 from decimal import Decimal
-from typing import List
+from typing import List, Optional
 
 from fastapi import HTTPException
 from pydantic import BaseModel, EmailStr, validator
@@ -50,12 +50,28 @@ class ShowUser(TunedModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 
 class UpdatedUserResponse(BaseModel):
     updated_user_id: uuid.UUID
 
 
+class RoleChangeRequest(BaseModel):
+    user_ids: List[uuid.UUID]
+
+
+class RoleChangeResponse(BaseModel):
+    changed: List[uuid.UUID]
+    skipped: List[uuid.UUID]
+    not_found: List[uuid.UUID]
+    inactive: List[uuid.UUID] = []
+
+
 class CategoryCreate(BaseModel):
     title: str
     description: str
@@ -84,6 +100,16 @@ class ShowPost(TunedModel):
     category_id: int
 
 
+class BulkPostError(BaseModel):
+    index: int
+    detail: str
+
+
+class BulkCreatePostsResponse(BaseModel):
+    created: List[ShowPost]
+    errors: List[BulkPostError]
+
+
 class ShowPostDetail(TunedModel):
     id: int
     title: str
@@ -93,5 +119,52 @@ class ShowPostDetail(TunedModel):
     category_name: str
 
 
+class PostPage(BaseModel):
+    items: List[ShowPostDetail]
+    page: int
+    size: int
+    total: Optional[int] = None
+    # 'exact', 'cached' (an exact count up to POSTS_COUNT_CACHE_TTL_SECONDS old) or 'estimated'
+    total_mode: Optional[str] = None
+    pages: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+
+class PostBatch(BaseModel):
+    items: List[ShowPostDetail]
+    missing: List[int]
+
+
+class CategoryFacet(BaseModel):
+    category_id: int
+    category_name: str
+    count: int
+
+
+class PriceBucket(BaseModel):
+    price_from: Decimal
+    # None for the last, open-ended bucket
+    price_to: Optional[Decimal] = None
+    count: int
+
+
+class PostFacets(BaseModel):
+    total: int
+    categories: List[CategoryFacet]
+    prices: List[PriceBucket]
+
+
 class DeletePostResponse(BaseModel):
-    deleted_post_id: int
\ No newline at end of file
+    deleted_post_id: int
+
+
+class ModerationDelete(BaseModel):
+    ids: Optional[List[int]] = None
+    user_id: Optional[uuid.UUID] = None
+    category_id: Optional[int] = None
+
+
+class ModerationDeleteResponse(BaseModel):
+    deleted: int
+    # matching posts may remain, repeat the request to continue
+    has_more: bool = False
@@ -1,15 +1,100 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, Response
 
 
+from admission import AdmissionMiddleware
 from api.user_router import router as user_routes
 from api.post_router import router as post_routes
+from api.post_cache import posts_cache
+from crud.post_crud import category_catalog, facet_counts
+from crud.user_crud import run_refresh_token_pruning, token_cache, user_cache
+from database.db import (BROADCAST_INVALIDATIONS, dispose_engine, engine, get_pool_stats,
+                         replica_router, warm_up_pool)
+from database.notify import broadcast
+from metrics import CONTENT_TYPE, Gauge, MetricsMiddleware, instrument_engine, registry
+from server import SERVER_HOST, SERVER_HTTP, SERVER_LOOP, SERVER_MODE, SERVER_PORT, run_production
+from utils import Hasher
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if BROADCAST_INVALIDATIONS:
+        # asyncpg takes the url without the SQLAlchemy driver name
+        broadcast.start(engine.url.set(drivername='postgresql').render_as_string(hide_password=False))
+    await warm_up_pool()
+    health_checks = None
+    if replica_router.engines:
+        await replica_router.check()
+        health_checks = asyncio.create_task(replica_router.run_health_checks())
+    await category_catalog.load()
+    await facet_counts.load()
+    token_pruning = asyncio.create_task(run_refresh_token_pruning())
+    yield
+    for task in (health_checks, token_pruning):
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+    await broadcast.stop()
+    Hasher.shutdown()
+    await dispose_engine()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+# added first, so it runs inside the metrics middleware and rejections are measured
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+# reads routed to the replicas are measured the same way
+for replica in replica_router.engines:
+    instrument_engine(replica)
+
 
-app = FastAPI()
+registry.register(Gauge(
+    'db_pool_connections', 'Connections of the pool by state.', ('state',),
+    lambda: {
+        ('checked_in',): engine.pool.checkedin(),
+        ('checked_out',): engine.pool.checkedout(),
+    },
+))
+registry.register(Gauge(
+    'db_pool_checkout_wait_seconds', 'Time checkouts waited for a connection.', ('stat',),
+    lambda: {
+        ('total',): get_pool_stats()['wait_seconds_total'],
+        ('max',): get_pool_stats()['wait_seconds_max'],
+    },
+))
+registry.register(Gauge(
+    'cache_requests', 'Lookups of the in-process caches.', ('cache', 'result'),
+    lambda: {
+        (name, result): cache.stats()[result]
+        for name, cache in (('tokens', token_cache), ('users', user_cache), ('posts', posts_cache))
+        for result in ('hits', 'misses')
+    },
+))
 
 
 app.include_router(user_routes, prefix="/user", tags=["user"])
 app.include_router(post_routes, prefix="/posts", tags=["posts"])
 
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/health", include_in_schema=False)
+async def health():
+    return {"status": "ok", "db_pool": get_pool_stats()}
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    if SERVER_MODE == "production":
+        run_production(app)
+    else:
+        uvicorn.run(
+            app, host=SERVER_HOST, port=SERVER_PORT, loop=SERVER_LOOP, http=SERVER_HTTP,
+        )
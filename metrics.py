@@ -0,0 +1,197 @@
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine.interfaces import CacheStats
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+"""
+Block for collecting metrics in the Prometheus text format.
+"""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labelnames: Tuple[str, ...], labels: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in self._values.items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per labels: counts of each bucket plus +Inf, then the sum
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                yield f'{self.name}_bucket{le} {cumulative}'
+            suffix = _format_labels(self.labelnames, labels)
+            yield f'{self.name}_sum{suffix} {total}'
+            yield f'{self.name}_count{suffix} {cumulative}'
+
+
+class Gauge:
+    """Gauge whose values are read from a callback at scrape time."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...],
+                 callback: Callable[[], Dict[Tuple, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.callback = callback
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} gauge'
+        for labels, value in self.callback().items():
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self._metrics for line in metric.collect()) + '\n'
+
+
+registry = Registry()
+
+http_requests_total = registry.register(Counter(
+    'http_requests_total', 'HTTP requests handled.', ('method', 'route', 'status'),
+))
+http_request_duration_seconds = registry.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request latency.', ('method', 'route'),
+))
+db_queries_total = registry.register(Counter(
+    'db_queries_total', 'SQL statements executed.', ('route',),
+))
+db_query_duration_seconds = registry.register(Histogram(
+    'db_query_duration_seconds', 'Time spent in SQL statements per request.', ('route',),
+))
+db_queries_per_request = registry.register(Histogram(
+    'db_queries_per_request', 'SQL statements executed per request.', ('route',),
+    buckets=QUERY_COUNT_BUCKETS,
+))
+db_compiled_cache_total = registry.register(Counter(
+    'db_compiled_cache_total', 'Lookups of SQL statements in the compiled cache.', ('result',),
+))
+
+_CACHE_RESULTS = {CacheStats.CACHE_HIT: 'hit', CacheStats.CACHE_MISS: 'miss'}
+
+
+class RequestDbStats:
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+
+_request_db_stats: ContextVar[Optional[RequestDbStats]] = ContextVar('request_db_stats', default=None)
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Count and time the statements of the current request, count compiled cache hits."""
+
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_compiled_cache_total.inc(_CACHE_RESULTS.get(context.cache_hit, 'uncached'))
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += time.perf_counter() - context._query_started
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and SQL statements per route.
+    Routes are labelled by their path template, so the label set stays small.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        stats = RequestDbStats()
+        token = _request_db_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_db_stats.reset(token)
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            method = scope['method']
+            http_requests_total.inc(method, path, status_code)
+            http_request_duration_seconds.observe(elapsed, method, path)
+            db_queries_per_request.observe(stats.queries, path)
+            if stats.queries:
+                db_queries_total.inc(path, amount=stats.queries)
+                db_query_duration_seconds.observe(stats.seconds, path)
@@ -0,0 +1,34 @@
+"""add listing indexes to posts
+
+Revision ID: 8c41d2e6b0f7
+Revises: 5b1e0c9a7f3d
+Create Date: 2026-10-18 14:03:27.561920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c41d2e6b0f7'
+down_revision: Union[str, None] = '5b1e0c9a7f3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_posts_price_id', 'posts', ['price', 'id'], unique=False)
+    op.create_index('ix_posts_title_id', 'posts', ['title', 'id'], unique=False)
+    op.create_index('ix_posts_category_id_id', 'posts', ['category_id', 'id'], unique=False)
+    op.create_index('ix_posts_category_id_price_id', 'posts', ['category_id', 'price', 'id'], unique=False)
+    op.create_index('ix_posts_category_id_title_id', 'posts', ['category_id', 'title', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_category_id_title_id', table_name='posts')
+    op.drop_index('ix_posts_category_id_price_id', table_name='posts')
+    op.drop_index('ix_posts_category_id_id', table_name='posts')
+    op.drop_index('ix_posts_title_id', table_name='posts')
+    op.drop_index('ix_posts_price_id', table_name='posts')
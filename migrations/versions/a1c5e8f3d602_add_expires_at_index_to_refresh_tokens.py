@@ -0,0 +1,26 @@
+"""add expires_at index to refresh tokens
+
+Revision ID: a1c5e8f3d602
+Revises: 4f7b2d9e8a13
+Create Date: 2026-10-18 21:06:14.583107
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a1c5e8f3d602'
+down_revision: Union[str, None] = '4f7b2d9e8a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_refresh_tokens_expires_at'), 'refresh_tokens', ['expires_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_refresh_tokens_expires_at'), table_name='refresh_tokens')
@@ -0,0 +1,26 @@
+"""add user_id index to posts
+
+Revision ID: e3a9f1c27b54
+Revises: 8c41d2e6b0f7
+Create Date: 2026-10-18 15:21:06.904377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e3a9f1c27b54'
+down_revision: Union[str, None] = '8c41d2e6b0f7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_posts_user_id_id', 'posts', ['user_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_user_id_id', table_name='posts')
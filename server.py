@@ -0,0 +1,60 @@
+from envparse import Env
+from uvicorn.workers import UvicornWorker
+
+from database.db import WEB_CONCURRENCY
+
+"""
+Block for running the app in production mode.
+"""
+env = Env()
+
+# variables to configure the server
+SERVER_MODE = env.str("SERVER_MODE", default="development")  # 'development' or 'production'
+SERVER_HOST = env.str("SERVER_HOST", default="0.0.0.0")
+SERVER_PORT = env.int("SERVER_PORT", default=8000)
+SERVER_LOOP = env.str("SERVER_LOOP", default="auto")  # 'auto', 'uvloop' or 'asyncio'
+SERVER_HTTP = env.str("SERVER_HTTP", default="auto")  # 'auto', 'httptools' or 'h11'
+# connections plus tasks a worker handles at once before answering 503, 0 for no limit
+SERVER_LIMIT_CONCURRENCY = env.int("SERVER_LIMIT_CONCURRENCY", default=0)
+SERVER_BACKLOG = env.int("SERVER_BACKLOG", default=2048)
+SERVER_KEEP_ALIVE = env.int("SERVER_KEEP_ALIVE", default=5)
+# a worker is replaced after this many requests (plus up to the jitter), 0 never
+SERVER_MAX_REQUESTS = env.int("SERVER_MAX_REQUESTS", default=10000)
+SERVER_MAX_REQUESTS_JITTER = env.int("SERVER_MAX_REQUESTS_JITTER", default=1000)
+SERVER_GRACEFUL_TIMEOUT = env.int("SERVER_GRACEFUL_TIMEOUT", default=30)
+
+
+class ServerWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": SERVER_LOOP,
+        "http": SERVER_HTTP,
+        "limit_concurrency": SERVER_LIMIT_CONCURRENCY or None,
+    }
+
+
+def run_production(app) -> None:
+    """
+    Gunicorn master with WEB_CONCURRENCY uvicorn workers. The master
+    replaces workers that exit, e.g. after SERVER_MAX_REQUESTS requests,
+    and each worker sizes its pool by database.db.DB_MAX_CONNECTIONS.
+    """
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": f"{SERVER_HOST}:{SERVER_PORT}",
+                "workers": WEB_CONCURRENCY,
+                "worker_class": "server.ServerWorker",
+                "backlog": SERVER_BACKLOG,
+                "keepalive": SERVER_KEEP_ALIVE,
+                "max_requests": SERVER_MAX_REQUESTS,
+                "max_requests_jitter": SERVER_MAX_REQUESTS_JITTER,
+                "graceful_timeout": SERVER_GRACEFUL_TIMEOUT,
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Server().run()
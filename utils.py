@@ -1,26 +1,197 @@
+import asyncio
+import base64
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from decimal import Decimal
-from typing import Optional
+from typing import Any, Callable, Hashable, Optional, Tuple
+from uuid import UUID
 from database.models import Post
 
+from fastapi import HTTPException
+from envparse import Env
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 from passlib.context import CryptContext
 from fastapi_filter import FilterDepends
 from fastapi_filter.contrib.sqlalchemy import Filter
 
+env = Env()
+
 pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
 
+# variables to configure the password hashing pool
+HASHER_EXECUTOR = env.str('HASHER_EXECUTOR', default='thread')  # 'thread' or 'process'
+HASHER_WORKERS = env.int('HASHER_WORKERS', default=2)
+HASHER_MAX_QUEUE = env.int('HASHER_MAX_QUEUE', default=32)
+
+
+def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _get_password_hash(password: str) -> str:
+    return pwd_context.hash(password)
+
 
 class Hasher:
     """
     Password hashing and verification.
+    The async methods run bcrypt in a worker pool, so the event loop
+    keeps serving other requests. At most HASHER_WORKERS + HASHER_MAX_QUEUE
+    calls may be pending, the rest are rejected with 503.
     """
+    _executor: Optional[Executor] = None
+    _slots: Optional[asyncio.Semaphore] = None
+
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str) -> bool:
-        return pwd_context.verify(plain_password, hashed_password)
+        return _verify_password(plain_password, hashed_password)
 
     @staticmethod
     def get_password_hash(password: str) -> str:
-        return pwd_context.hash(password)
-    
+        return _get_password_hash(password)
+
+    @classmethod
+    async def verify_password_async(cls, plain_password: str, hashed_password: str) -> bool:
+        return await cls._run(_verify_password, plain_password, hashed_password)
+
+    @classmethod
+    async def get_password_hash_async(cls, password: str) -> str:
+        return await cls._run(_get_password_hash, password)
+
+    @classmethod
+    async def _run(cls, func, *args):
+        if cls._executor is None:
+            if HASHER_EXECUTOR == 'process':
+                cls._executor = ProcessPoolExecutor(max_workers=HASHER_WORKERS)
+            else:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=HASHER_WORKERS, thread_name_prefix='hasher'
+                )
+            cls._slots = asyncio.Semaphore(HASHER_WORKERS + HASHER_MAX_QUEUE)
+        if cls._slots.locked():
+            raise HTTPException(
+                status_code=503,
+                detail='Too many authentication requests, try again later.',
+                headers={'Retry-After': '1'},
+            )
+        async with cls._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(cls._executor, func, *args)
+
+    @classmethod
+    def shutdown(cls) -> None:
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=True)
+            cls._executor = None
+            cls._slots = None
+
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache whose entries expire after a TTL.
+    With maxweight the entries are also limited by their total weight,
+    e.g. the size in bytes given by the weigh function.
+    """
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        maxweight: Optional[int] = None,
+        weigh: Callable[[Any], int] = lambda value: 1,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value, _ = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        weight = self.weigh(value)
+        if self.maxsize <= 0 or (self.maxweight is not None and weight > self.maxweight):
+            return
+        self.pop(key)
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value, weight)
+        self.weight += weight
+        while len(self._data) > self.maxsize or (
+            self.maxweight is not None and self.weight > self.maxweight
+        ):
+            _, (_, _, evicted_weight) = self._data.popitem(last=False)
+            self.weight -= evicted_weight
+
+    def pop(self, key: Hashable) -> None:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.weight -= item[2]
+
+    def pop_if(self, predicate: Callable[[Any], bool]) -> None:
+        """Drop every entry whose value satisfies the predicate."""
+        for key in [key for key, (_, value, _) in self._data.items() if predicate(value)]:
+            self.pop(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.weight = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'weight': self.weight,
+            'maxweight': self.maxweight,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) of a statement, its parameters stay bound.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def plan_of(explain_result) -> dict:
+    """The top plan node of an EXPLAIN (FORMAT JSON) result."""
+    plan = explain_result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+# columns the post listings may be sorted by, each has an index ending with id
+POST_SORT_COLUMNS = {
+    'id': Post.id,
+    'price': Post.price,
+    'title': Post.title,
+}
 
 
 class PostFilter(Filter):
@@ -31,9 +202,40 @@ class PostFilter(Filter):
     price__gte: Optional[Decimal] = None
     price__lte: Optional[Decimal] = None
     category_id: Optional[int] = None
+    user_id: Optional[UUID] = None
 
     class Constants(Filter.Constants):
         model = Post
 
     class Config:
-        allow_population_by_field_name = True
\ No newline at end of file
+        allow_population_by_field_name = True
+
+
+def encode_cursor(sort_by: str, sort_desc: bool, value: Any, post_id: int) -> str:
+    """
+    Build an opaque keyset cursor from the last post of a page.
+    """
+    payload = [sort_by, sort_desc, None if value is None else str(value), post_id]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort_by: str, sort_desc: bool) -> Tuple[Any, int]:
+    """
+    Unpack a keyset cursor into the sort column value and the post id.
+    The cursor must have been issued for the same sorting.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort_by, cursor_sort_desc, value, post_id = json.loads(raw)
+        column = POST_SORT_COLUMNS[cursor_sort_by]
+        if value is not None:
+            value = column.type.python_type(value)
+        post_id = int(post_id)
+    except (ValueError, TypeError, ArithmeticError, KeyError, NotImplementedError):
+        raise HTTPException(status_code=400, detail='Invalid cursor.')
+    if cursor_sort_by != sort_by or cursor_sort_desc != sort_desc:
+        raise HTTPException(
+            status_code=400, detail='Cursor does not match the requested sorting.'
+        )
+    return value, post_id